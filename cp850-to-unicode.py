@@ -1,51 +1,169 @@
 #!/usr/bin/env python
 """
 Converts a QwkWeb SQLite database in cp850 encoding to unicode.
+
+Messages are read from the old database in chunks of rowids, decoded in
+a pool of processes and written to the new database through the packet
+importer, which also fills in the thread table and forum counts. The
+last rowid written is kept in the new database, so an interrupted
+conversion carries on where it stopped when run again.
 """
 import sys
+import time
+import optparse
+import multiprocessing
 from sqlite3 import dbapi2 as sqlite
+from qwkimport import DecodedPacket, PacketImporter
+import qwkdb
 
 
-def sqlquote(value):
+def decode(value):
     """
-    Quote for SQL and convert cp850 to unicode.
+    Convert cp850 to unicode.
     """
+    if isinstance(value, buffer):
+        value = str(value)
     if isinstance(value, str):
         value = unicode(value, 'cp850')
-    if isinstance(value, basestring):
-        return u"'%s'" % value.replace(u"'", u"''")
-    elif isinstance(value, (int, long, float)):
-        return value
+    return value
+
+
+def plain(value):
+    """
+    Convert BLOB values to strings, as buffers cannot be passed to the
+    decoding processes.
+    """
+    if isinstance(value, buffer):
+        value = str(value)
+    return value
+
+
+def decodeRows(rows):
+    """
+    Convert all values in a list of rows.
+    """
+    return [tuple([decode(x) for x in row]) for row in rows]
+
+
+class ConvertedRows(DecodedPacket):
+    """
+    Converted messages of one board, passed to the importer as if they
+    came from a packet.
+    """
+    def __init__(self, bbsid, bbsname, forums, messages):
+        self.bbsid = bbsid
+        self.bbsname = bbsname
+        self.forums = forums
+        self.private = {}
+        self.messages = messages
 
 
 def main(argv):
-    if len(argv) != 3:
-        print >> sys.stderr, "Syntax: %s old.db new.db" % argv[0]
-        print >> sys.stderr, "New db must exist but have no contents."
+    parser = optparse.OptionParser(
+        usage='%prog [options] old.db new.db',
+        description='New db must exist but have no contents, other than '
+                    'that of an interrupted conversion.')
+    parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count(),
+                      help='number of processes decoding messages '
+                           '(default: the number of CPUs)')
+    parser.add_option('-c', '--chunk', type='int', default=5000,
+                      help='messages read and written at a time (default: 5000)')
+    parser.add_option('-t', '--timeout', type='int', default=600,
+                      help='seconds to wait for a chunk to be decoded before '
+                           'giving up (default: 600)')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error('an old and a new database are required')
 
-    con1 = sqlite.connect(argv[1])
+    con1 = sqlite.connect(args[0])
     con1.text_factory = str
     cur1 = con1.cursor()
-    con2 = sqlite.connect(argv[2])
+    con2 = qwkdb.connect(args[1])
     cur2 = con2.cursor()
+    cur2.execute('CREATE TABLE IF NOT EXISTS cp850_checkpoint (lastrowid INTEGER NOT NULL)')
+    con2.commit()
 
-    # Convert table board
+    # Convert tables board and forum, which are small
     cur1.execute('SELECT id, title FROM board')
-    for result in cur1.fetchall():
-        cur2.execute(u'INSERT INTO board (id, title) VALUES (%s, %s)' %
-                     tuple([sqlquote(x) for x in result]))
-    # Convert for table forum
+    boards = dict(decodeRows(cur1.fetchall()))
+    cur2.executemany('INSERT OR IGNORE INTO board (id, title) VALUES (?, ?)',
+                     boards.items())
     cur1.execute('SELECT id, boardid, title FROM forum')
-    for result in cur1.fetchall():
-        cur2.execute(u'INSERT into forum (id, boardid, title) VALUES '\
-                     u'(%s, %s, %s)' % tuple(
-                         [sqlquote(x) for x in result]))
-    # Convert for table message
-    cur1.execute('SELECT id, forumid, boardid, mdate, mtime, mto, mfrom, reference, subject, body FROM message')
-    for result in cur1.fetchall():
-        cur2.execute(u'INSERT into message (id, forumid, boardid, mdate, mtime, mto, mfrom, reference, subject, body) VALUES '\
-                     u'(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)' % tuple(
-                         [sqlquote(x) for x in result]))
+    forums = {}
+    for forum, board, title in decodeRows(cur1.fetchall()):
+        forums.setdefault(board, {})[forum] = title
+    cur2.executemany('INSERT OR IGNORE INTO forum (id, boardid, title) VALUES (?, ?, ?)',
+                     [(forum, board, forums[board][forum])
+                      for board in forums for forum in forums[board]])
+    con2.commit()
+
+    # Convert table message, resuming after the last chunk written
+    cur2.execute('SELECT lastrowid FROM cp850_checkpoint')
+    checkpoint = cur2.fetchone()
+    lastrowid = checkpoint and checkpoint[0] or 0
+    cur1.execute('SELECT count(*), max(rowid) FROM message WHERE rowid > ?', (lastrowid,))
+    remaining, maxrowid = cur1.fetchone()
+    importer = PacketImporter(con2)
+    pool = multiprocessing.Pool(options.jobs)
+    started = time.time()
+    done = 0
+    try:
+        while lastrowid < maxrowid:
+            # Read a few chunks for the pool to decode at once
+            chunks = []
+            for x in range(options.jobs):
+                cur1.execute('SELECT rowid, id, forumid, boardid, mdate, mtime, mto, mfrom, '
+                             'reference, subject, body FROM message WHERE rowid > ? '
+                             'ORDER BY rowid LIMIT ?', (lastrowid, options.chunk))
+                rows = cur1.fetchall()
+                if not rows:
+                    break
+                lastrowid = rows[-1][0]
+                chunks.append([tuple([plain(x) for x in row[1:]]) for row in rows])
+            # A pool does not notice when one of its processes dies, and
+            # would wait for its chunk forever
+            results = pool.imap(decodeRows, chunks)
+            for x in range(len(chunks)):
+                try:
+                    rows = results.next(options.timeout)
+                except multiprocessing.TimeoutError:
+                    print >> sys.stderr
+                    print >> sys.stderr, "A chunk was not decoded in %d seconds, stopping. " \
+                                         "Run again to carry on." % options.timeout
+                    return 1
+                byboard = {}
+                for row in rows:
+                    byboard.setdefault(row[2], []).append(row)
+                # The importer commits each board's messages. Messages
+                # already there are skipped, so if the conversion stops
+                # before the checkpoint is written, nothing is lost.
+                for board in byboard:
+                    # The importer adds the boards and forums it is
+                    # given, so messages in ones missing from the old
+                    # database get made up titles rather than failing.
+                    if board not in boards:
+                        print >> sys.stderr, "\nBoard %s is missing, adding it." % board
+                        boards[board] = board
+                    for forum in set([row[1] for row in byboard[board]]):
+                        if forum not in forums.setdefault(board, {}):
+                            print >> sys.stderr, "\nForum %d of board %s is missing, " \
+                                                 "adding it." % (forum, board)
+                            forums[board][forum] = u'Forum %d' % forum
+                    importer.importPacket(ConvertedRows(board, boards[board],
+                                                        forums[board], byboard[board]))
+                done += len(rows)
+                print >> sys.stderr, "\r%d of %d messages (%.0f messages/s)" % (
+                    done, remaining, done / max(time.time() - started, 0.001)),
+            cur2.execute('DELETE FROM cp850_checkpoint')
+            cur2.execute('INSERT INTO cp850_checkpoint (lastrowid) VALUES (?)', (lastrowid,))
+            con2.commit()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    print >> sys.stderr
+
+    cur2.execute('DROP TABLE cp850_checkpoint')
     con2.commit()
     con2.close()
 
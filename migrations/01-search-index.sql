@@ -0,0 +1,32 @@
+-- Adds the full-text search index to a database created before it existed.
+--
+--   sqlite3 qwkweb.db < migrations/01-search-index.sql
+
+-- Full-text index over message text. The index stores no text of its own
+-- and reads it from the message table, keyed on message's rowid. Run
+-- INSERT INTO message_fts (message_fts) VALUES ('rebuild') after a VACUUM,
+-- as SQLite may renumber message rowids.
+CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5 (
+    subject, body, mfrom, mto,
+    content='message', content_rowid='rowid'
+    );
+
+CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+    INSERT INTO message_fts (rowid, subject, body, mfrom, mto)
+        VALUES (new.rowid, new.subject, new.body, new.mfrom, new.mto);
+END;
+
+CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+    INSERT INTO message_fts (message_fts, rowid, subject, body, mfrom, mto)
+        VALUES ('delete', old.rowid, old.subject, old.body, old.mfrom, old.mto);
+END;
+
+CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE ON message BEGIN
+    INSERT INTO message_fts (message_fts, rowid, subject, body, mfrom, mto)
+        VALUES ('delete', old.rowid, old.subject, old.body, old.mfrom, old.mto);
+    INSERT INTO message_fts (rowid, subject, body, mfrom, mto)
+        VALUES (new.rowid, new.subject, new.body, new.mfrom, new.mto);
+END;
+
+-- Index the messages already in the archive.
+INSERT INTO message_fts (message_fts) VALUES ('rebuild');
@@ -0,0 +1,13 @@
+-- Adds cached per-forum message counts and the indexes used to page
+-- through forums.
+--
+--   sqlite3 qwkweb.db < migrations/02-forum-paging.sql
+
+ALTER TABLE forum ADD COLUMN mcount INTEGER NOT NULL DEFAULT 0;
+
+UPDATE forum SET mcount = (SELECT count(*) FROM message
+    WHERE message.boardid = forum.boardid AND message.forumid = forum.id);
+
+-- Indexes for paging through a forum by message number or date.
+CREATE INDEX IF NOT EXISTS message_forum_id ON message (boardid, forumid, id);
+CREATE INDEX IF NOT EXISTS message_forum_date ON message (boardid, forumid, mdate, mtime, id);
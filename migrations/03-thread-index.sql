@@ -0,0 +1,60 @@
+-- Adds the thread table and fills it in for the messages already in the
+-- archive.
+--
+--   sqlite3 qwkweb.db < migrations/03-thread-index.sql
+
+-- Where each message sits in its thread and in its forum. Maintained by
+-- the importer. parent is the message replied to, if it is in the
+-- archive; root is the first message of the thread. prevno and nextno
+-- are the neighbouring message numbers in the forum.
+CREATE TABLE IF NOT EXISTS thread (
+    id INTEGER NOT NULL,
+    forumid INTEGER NOT NULL,
+    boardid TEXT NOT NULL,
+
+    reference INTEGER,
+    parent INTEGER,
+    root INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    prevno INTEGER,
+    nextno INTEGER,
+
+    PRIMARY KEY (boardid, forumid, id)
+    );
+
+CREATE INDEX IF NOT EXISTS thread_parent ON thread (boardid, forumid, parent);
+CREATE INDEX IF NOT EXISTS thread_root ON thread (boardid, forumid, root);
+-- Replies whose parent has not arrived yet.
+CREATE INDEX IF NOT EXISTS thread_orphan ON thread (boardid, forumid, reference)
+    WHERE parent IS NULL;
+
+-- Temporary index for walking down from each thread's first message.
+CREATE INDEX message_reference ON message (boardid, forumid, reference);
+
+INSERT OR IGNORE INTO thread (id, forumid, boardid, reference, parent, root, depth)
+    WITH RECURSIVE tree (id, forumid, boardid, reference, parent, root, depth) AS (
+        SELECT id, forumid, boardid, reference, NULL, id, 0 FROM message
+            WHERE NOT EXISTS (SELECT 1 FROM message AS p
+                WHERE p.boardid = message.boardid AND p.forumid = message.forumid
+                AND p.id = message.reference AND p.id != message.id)
+        UNION ALL
+        SELECT message.id, message.forumid, message.boardid, message.reference,
+               tree.id, tree.root, tree.depth + 1
+            FROM tree JOIN message ON message.boardid = tree.boardid
+                AND message.forumid = tree.forumid AND message.reference = tree.id
+                AND message.id != tree.id
+        )
+    SELECT * FROM tree;
+
+-- Messages in a reference loop have no first message. Start threads at
+-- each of them.
+INSERT OR IGNORE INTO thread (id, forumid, boardid, reference, parent, root, depth)
+    SELECT id, forumid, boardid, reference, NULL, id, 0 FROM message;
+
+DROP INDEX message_reference;
+
+UPDATE thread SET
+    prevno = (SELECT max(id) FROM thread AS t WHERE t.boardid = thread.boardid
+        AND t.forumid = thread.forumid AND t.id < thread.id),
+    nextno = (SELECT min(id) FROM thread AS t WHERE t.boardid = thread.boardid
+        AND t.forumid = thread.forumid AND t.id > thread.id);
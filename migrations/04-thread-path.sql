@@ -0,0 +1,27 @@
+-- Adds thread paths, used to list a whole thread in reply order.
+--
+--   sqlite3 qwkweb.db < migrations/04-thread-path.sql
+
+ALTER TABLE thread ADD COLUMN path TEXT NOT NULL DEFAULT '';
+
+CREATE TEMP TABLE thread_path AS
+    WITH RECURSIVE tree (id, forumid, boardid, path) AS (
+        SELECT id, forumid, boardid, printf('%07d/', id) FROM thread
+            WHERE parent IS NULL
+        UNION ALL
+        SELECT thread.id, thread.forumid, thread.boardid,
+               tree.path || printf('%07d/', thread.id)
+            FROM tree JOIN thread ON thread.boardid = tree.boardid
+                AND thread.forumid = tree.forumid AND thread.parent = tree.id
+        )
+    SELECT * FROM tree;
+CREATE UNIQUE INDEX temp.thread_path_id ON thread_path (boardid, forumid, id);
+
+UPDATE thread SET path = (SELECT path FROM thread_path
+    WHERE thread_path.boardid = thread.boardid
+    AND thread_path.forumid = thread.forumid AND thread_path.id = thread.id);
+
+DROP TABLE thread_path;
+
+DROP INDEX IF EXISTS thread_root;
+CREATE INDEX IF NOT EXISTS thread_path ON thread (boardid, forumid, root, path);
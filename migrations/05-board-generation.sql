@@ -0,0 +1,6 @@
+-- Adds the board generation counters used to expire cached pages.
+--
+--   sqlite3 qwkweb.db < migrations/05-board-generation.sql
+
+ALTER TABLE board ADD COLUMN generation INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE board ADD COLUMN modified INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,11 @@
+-- Adds the log of imported packets used to resume bulk imports.
+--
+--   sqlite3 qwkweb.db < migrations/06-packet-log.sql
+
+CREATE TABLE packet (
+    checksum TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    boardid TEXT NOT NULL,
+    messages INTEGER NOT NULL,
+    imported INTEGER NOT NULL
+    );
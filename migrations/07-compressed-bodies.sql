@@ -0,0 +1,49 @@
+-- Adds the dictionaries for compressed message bodies, and points the
+-- full-text index at the decompressed text. Run this before compressing
+-- any bodies with qwkcompress.py.
+--
+--   sqlite3 qwkweb.db < migrations/07-compressed-bodies.sql
+
+CREATE TABLE bodydict (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+    );
+
+CREATE VIEW message_text AS
+    SELECT rowid AS msgrowid, subject, qwkbody(body) AS body, mfrom, mto FROM message;
+
+-- The index's content table cannot be changed, so it is made again.
+DROP TRIGGER message_fts_insert;
+DROP TRIGGER message_fts_delete;
+DROP TRIGGER message_fts_update;
+DROP TABLE message_fts;
+
+CREATE VIRTUAL TABLE message_fts USING fts5 (
+    subject, body, mfrom, mto,
+    content='message_text', content_rowid='msgrowid'
+    );
+
+CREATE TRIGGER message_fts_insert AFTER INSERT ON message BEGIN
+    INSERT INTO message_fts (rowid, subject, body, mfrom, mto)
+        VALUES (new.rowid, new.subject, qwkbody(new.body), new.mfrom, new.mto);
+END;
+
+CREATE TRIGGER message_fts_delete AFTER DELETE ON message BEGIN
+    INSERT INTO message_fts (message_fts, rowid, subject, body, mfrom, mto)
+        VALUES ('delete', old.rowid, old.subject, qwkbody(old.body), old.mfrom, old.mto);
+END;
+
+CREATE TRIGGER message_fts_update AFTER UPDATE ON message
+    WHEN old.subject IS NOT new.subject OR old.mfrom IS NOT new.mfrom
+        OR old.mto IS NOT new.mto OR qwkbody(old.body) IS NOT qwkbody(new.body)
+BEGIN
+    INSERT INTO message_fts (message_fts, rowid, subject, body, mfrom, mto)
+        VALUES ('delete', old.rowid, old.subject, qwkbody(old.body), old.mfrom, old.mto);
+    INSERT INTO message_fts (rowid, subject, body, mfrom, mto)
+        VALUES (new.rowid, new.subject, qwkbody(new.body), new.mfrom, new.mto);
+END;
+
+-- Index the messages already in the archive. None are compressed yet,
+-- so they are read straight from the message table.
+INSERT INTO message_fts (rowid, subject, body, mfrom, mto)
+    SELECT rowid, subject, body, mfrom, mto FROM message;
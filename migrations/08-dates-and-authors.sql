@@ -0,0 +1,53 @@
+-- Adds message timestamps and authors, and the indexes for browsing by
+-- date and by author, filling them in for the messages already there.
+--
+--   sqlite3 qwkweb.db < migrations/08-dates-and-authors.sql
+
+CREATE TABLE author (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE COLLATE NOCASE
+    );
+
+ALTER TABLE message ADD COLUMN posted INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE message ADD COLUMN fromid INTEGER REFERENCES author(id);
+ALTER TABLE message ADD COLUMN toid INTEGER REFERENCES author(id);
+
+-- Only run the search index trigger when indexed columns change, so that
+-- the updates below do not need qwkbody().
+DROP TRIGGER message_fts_update;
+CREATE TRIGGER message_fts_update
+    AFTER UPDATE OF subject, body, mfrom, mto ON message
+    WHEN old.subject IS NOT new.subject OR old.mfrom IS NOT new.mfrom
+        OR old.mto IS NOT new.mto OR qwkbody(old.body) IS NOT qwkbody(new.body)
+BEGIN
+    INSERT INTO message_fts (message_fts, rowid, subject, body, mfrom, mto)
+        VALUES ('delete', old.rowid, old.subject, qwkbody(old.body), old.mfrom, old.mto);
+    INSERT INTO message_fts (rowid, subject, body, mfrom, mto)
+        VALUES (new.rowid, new.subject, qwkbody(new.body), new.mfrom, new.mto);
+END;
+
+INSERT OR IGNORE INTO author (name)
+    SELECT mfrom FROM message UNION SELECT mto FROM message;
+
+-- The same as qwk.timestamp(): mm-dd-yy with years below 80 in the
+-- 2000s, and 0 unless the date and time are valid. datetime() only
+-- checks the ranges of the fields, so the date is put through a modifier
+-- to have days past the end of the month and 24:00 carried over.
+UPDATE message SET
+    posted = coalesce((SELECT CAST(strftime('%s', iso) AS INTEGER)
+        FROM (SELECT printf('%04d-%s-%s %s:00',
+                  CAST(substr(mdate, 7, 2) AS INTEGER) +
+                      CASE WHEN CAST(substr(mdate, 7, 2) AS INTEGER) < 80
+                           THEN 2000 ELSE 1900 END,
+                  substr(mdate, 1, 2), substr(mdate, 4, 2), mtime) AS iso)
+        WHERE mdate GLOB '[0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+            AND mtime GLOB '[0-9][0-9]:[0-9][0-9]'
+            AND datetime(iso, '+0 days') = iso), 0),
+    fromid = (SELECT id FROM author WHERE name = message.mfrom),
+    toid = (SELECT id FROM author WHERE name = message.mto);
+
+DROP INDEX message_forum_date;
+CREATE INDEX message_forum_posted ON message (boardid, forumid, posted, id);
+CREATE INDEX message_posted ON message (posted);
+CREATE INDEX message_from ON message (fromid, posted);
+CREATE INDEX message_to ON message (toid, posted);
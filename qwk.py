@@ -2,15 +2,29 @@
 # QWK library.
 
 """
-QWK library in Python. Only implements reading messages out of a Zip
-compressed QWK packet.
+QWK library in Python. Implements reading messages out of a Zip
+compressed QWK packet, or out of a directory with the packet's
+contents unpacked, and writing QWK packets.
 """
 
 __version__='0.1'
 
+import os
+import re
+import mmap
+import string
+import time
 import struct
-from zipfile import ZipFile
+import calendar
+import tempfile
+from datetime import datetime
+from itertools import izip
+from zipfile import ZipFile, ZIP_DEFLATED
 from StringIO import StringIO
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #MESSAGES.DAT record:
 #Offset  Length  Description
@@ -53,12 +67,104 @@ from StringIO import StringIO
 #                status) generally leave this as a space.  Only network
 #                softwares need this information.
 
-class QwkMessage:
+#NDX record, one per message in a conference's NNN.NDX file:
+#Offset  Length  Description
+#------  ------  ----------------------------------------------------
+#    1       4   Record number of the message header in MESSAGES.DAT,
+#                counting 128-byte blocks from 1, as a Microsoft
+#                Binary Format (MBF) single precision float
+#    5       1   Conference number (unsigned character)
+
+# Two digit years below this are taken to be in the 2000s. QWK dates
+# from 1987 on.
+YEARPIVOT = 80
+
+# Characters padding header fields. Fields are meant to be padded with
+# spaces, but some doors pad them with null bytes.
+PADDING = string.whitespace + '\0'
+
+# Translates QWK's EOL characters (ASCII 227) to newlines. Null bytes
+# are deleted in the same pass.
+body_table = string.maketrans(chr(227), '\n')
+
+def msbin(number):
     """
-    Contains the headers and body of a QWK message.
+    Converts a number to a four byte Microsoft Binary Format float, as
+    used in NDX files.
+    """
+    ieee = struct.unpack('<I', struct.pack('<f', number))[0]
+    if not ieee & 0x7fffffff:
+        return '\0\0\0\0'
+    # MBF has the exponent in the top byte, biased by two more than
+    # IEEE's, followed by the sign and the mantissa.
+    exponent = (ieee >> 23) & 0xff
+    return struct.pack('<I', ((exponent + 2) << 24) | ((ieee >> 8) & 0x800000) |
+                       (ieee & 0x7fffff))
+
+def unmsbin(data):
+    """
+    Converts a four byte Microsoft Binary Format float, as used in NDX
+    files, to a number.
+    """
+    value = struct.unpack('<I', data)[0]
+    exponent = value >> 24
+    if exponent <= 2:
+        return 0
+    ieee = ((exponent - 2) << 23) | ((value & 0x800000) << 8) | (value & 0x7fffff)
+    return struct.unpack('<f', struct.pack('<I', ieee))[0]
+
+def timestamp(date, time):
     """
+    Converts a message's date (mm-dd-yy) and time (hh:mm) to a Unix
+    time, taking them to be UTC as QWK has no time zones. Two digit
+    years below YEARPIVOT are in the 2000s, the rest in the 1900s.
+    Returns 0 if the date or time is not valid.
+    """
+    dates = re.match(r'^(\d\d)-(\d\d)-(\d\d)$', date)
+    times = re.match(r'^(\d\d):(\d\d)$', time)
+    if not dates or not times:
+        return 0
+    month, day, year = [int(x) for x in dates.groups()]
+    year += year < YEARPIVOT and 2000 or 1900
+    try:
+        posted = datetime(year, month, day, *[int(x) for x in times.groups()])
+    except ValueError:
+        return 0
+    return calendar.timegm(posted.timetuple())
+
+def _decoded(name):
+    """
+    Returns a property that decodes the named text attribute from the
+    message's encoding on first access and caches the result.
+    """
+    cache = '_u' + name
+    def get(self):
+        value = getattr(self, cache)
+        if value is None:
+            value = unicode(getattr(self, name), self.encoding)
+            setattr(self, cache, value)
+        return value
+    return property(get, doc="%s, decoded to unicode." % name)
+
+class QwkMessage(object):
+    """
+    Contains the headers and body of a QWK message. Text is kept as the
+    raw bytes found in the packet; the u-prefixed attributes (udate,
+    utime, umto, umfrom, usubject and ubody) decode it to unicode when
+    first used. The body may be given as rawbody, a buffer over the
+    message's MESSAGES.DAT blocks, in which case it is only cleaned up
+    when first accessed.
+    """
+    __slots__ = ('status', 'number', 'date', 'time', 'mto', 'mfrom',
+                 'subject', 'password', 'reference', 'forum', 'private',
+                 '_body', '_rawbody', '_udate', '_utime', '_umto',
+                 '_umfrom', '_usubject', '_ubody')
+
+    # Character set used by QWK packets.
+    encoding = 'cp850'
+
     def __init__(self, status, number, date, time, mto, mfrom, subject,
-        password, reference, forum, body):
+        password, reference, forum, body=None, rawbody=None):
         self.status = status
         self.number = number
         self.date = date
@@ -69,12 +175,35 @@ class QwkMessage:
         self.password = password
         self.reference = reference
         self.forum = forum
-        self.body = body
+        self._body = body
+        self._rawbody = rawbody
+        self._udate = self._utime = self._umto = self._umfrom = None
+        self._usubject = self._ubody = None
         if status in ['*', '+']:
             self.private = 1
         else:
             self.private = 0
 
+    def _getBody(self):
+        if self._rawbody is not None:
+            self._body = str(self._rawbody).translate(body_table, chr(0))
+            self._rawbody = None
+        return self._body
+
+    def _setBody(self, body):
+        self._body = body
+        self._rawbody = None
+        self._ubody = None
+
+    body = property(_getBody, _setBody)
+
+    udate = _decoded('date')
+    utime = _decoded('time')
+    umto = _decoded('mto')
+    umfrom = _decoded('mfrom')
+    usubject = _decoded('subject')
+    ubody = _decoded('body')
+
 class QwkPacket:
     """
     Opens and reads messages from a QWK packet.
@@ -82,16 +211,41 @@ class QwkPacket:
 
     # MESSAGES.DAT header record. See commented area above.
     record_layout = '<c7s8s5s25s25s25s12s8s6sxHxxx'
+    # The same layout as a numpy record, used to decode headers in bulk.
+    if numpy is not None:
+        record_dtype = numpy.dtype([('status', 'S1'), ('number', 'S7'),
+            ('date', 'S8'), ('time', 'S5'), ('to', 'S25'), ('from', 'S25'),
+            ('subject', 'S25'), ('password', 'S12'), ('reference', 'S8'),
+            ('blocks', 'S6'), ('flag', 'S1'), ('forum', '<u2'),
+            ('lognumber', '<u2'), ('tagline', 'S1')])
 
-    def __init__(self, packet):
+    # Bytes of MESSAGES.DAT read and decoded at a time by iter_messages().
+    chunk_size = 1024 * 1024
+    # Headers decoded at a time when MESSAGES.DAT is memory mapped.
+    batch_size = 4096
+
+    def __init__(self, packet, eager=True):
         """
         Creates a new QwkPacket instance. The packet parameter must
-        be a file name or a file like object.
+        be a file name or a file like object, or the name of a directory
+        the packet has been unpacked into. If eager is False,
+        messages are not read up front and the messages attribute
+        and per-forum message lists are left empty; use
+        iter_messages() to stream them instead.
         """
-        # Open packet
-        zip = ZipFile(packet, 'r')
+        self.packet = packet
+        self.messages = []
+        # Offsets of the messages in MESSAGES.DAT, all of them and per
+        # forum, loaded when first needed.
+        self._offsets = None
+        self._forumOffsets = None
         # Read CONTROL.DAT
-        cd = StringIO(zip.read('CONTROL.DAT'))
+        if self._unpacked():
+            cd = open(os.path.join(packet, 'CONTROL.DAT'), 'rb')
+        else:
+            zip = ZipFile(packet, 'r')
+            cd = StringIO(zip.read('CONTROL.DAT'))
+            zip.close()
         controldat = cd.readlines()
         cd.close()
         # Read BBS id
@@ -100,27 +254,66 @@ class QwkPacket:
         # Read forum list
         self._readForums(controldat)
         # Read messages
-        md = StringIO(zip.read('MESSAGES.DAT'))
-        self._readMessages(md)
-        # Wrap up
-        md.close()
-        zip.close()
-
-    def _decodeHeader(self, data):
-        headers = struct.unpack(self.record_layout, data)
-        hd = {}
-        hd['status'] = headers[0]
-        hd['number'] = int(headers[1].strip() or 0)
-        hd['date'] = headers[2].strip()
-        hd['time'] = headers[3].strip()
-        hd['to'] = headers[4].strip()
-        hd['from'] = headers[5].strip()
-        hd['subject']= headers[6].strip()
-        hd['password'] = headers[7].strip()
-        hd['reference'] = int(headers[8].strip() or 0)
-        hd['blocks'] = int(headers[9].strip() or 0)
-        hd['forum'] = headers[10]
-        return hd
+        if eager:
+            self._readMessages()
+
+    def _unpacked(self):
+        """
+        Returns True if the packet is a directory rather than a Zip
+        file.
+        """
+        return isinstance(self.packet, basestring) and os.path.isdir(self.packet)
+
+    def _scanHeaders(self, data, eof, offset=0):
+        """
+        Finds the offsets of all message headers in data, starting at
+        offset, by hopping along the block count fields. Returns the
+        list of offsets of complete messages and the offset where the
+        first incomplete one begins. If eof is true, a truncated last
+        message is included.
+        """
+        offsets = []
+        size = len(data)
+        while offset + 128 <= size:
+            end = offset + 128 * max(int(data[offset+116:offset+122].strip(PADDING) or 0), 1)
+            if end > size and not eof:
+                break
+            offsets.append(offset)
+            offset = end
+        return offsets, offset
+
+    def _decodeHeaders(self, data, offsets):
+        """
+        Decodes the headers at the given offsets of data in one batch.
+        Returns a list of (status, number, date, time, to, from,
+        subject, password, reference, blocks, forum) tuples.
+        """
+        if not offsets:
+            return []
+        if numpy is not None:
+            # Gather the 128-byte headers into one array and view it as
+            # an array of records.
+            raw = numpy.frombuffer(data, numpy.uint8)
+            records = raw[numpy.array(offsets)[:, numpy.newaxis] +
+                          numpy.arange(128)].view(self.record_dtype)[:, 0]
+            columns = [records[name].tolist() for name in ('status',
+                'number', 'date', 'time', 'to', 'from', 'subject',
+                'password', 'reference', 'blocks', 'forum')]
+        else:
+            # Unpack all headers with a single struct call, then pick
+            # the fields out column by column.
+            values = struct.unpack('<' + self.record_layout[1:] * len(offsets),
+                ''.join([data[offset:offset+128] for offset in offsets]))
+            columns = [values[x::11] for x in range(11)]
+        # numpy drops trailing null bytes from text fields and struct
+        # keeps them, so strip them either way. A null status byte
+        # counts as a blank one.
+        columns[0] = [value.strip('\0') or ' ' for value in columns[0]]
+        for x in (2, 3, 4, 5, 6, 7):
+            columns[x] = [value.strip(PADDING) for value in columns[x]]
+        for x in (1, 8, 9):
+            columns[x] = [int(value.strip(PADDING) or 0) for value in columns[x]]
+        return zip(*columns)
 
     def _readForums(self, controldat):
         """
@@ -133,37 +326,323 @@ class QwkPacket:
                 controldat[x+1].strip(), 'messages': []}
         self.forums = forums
 
-    def _readMessages(self, file):
+    def _readMessages(self):
         """
-        Reads messages out of a MESSAGES.DAT file. Parameter is a
-        file like object.
+        Reads all messages into the messages attribute and the
+        per-forum message lists.
         """
         messages = []
-        file.seek(128, 0) # Skip the copyright header
-
-        block = file.read(128)
-        while block != '':
-            headers = self._decodeHeader(block)
-            body = ''
-            for x in range(headers['blocks'] - 1):
-                body = body + file.read(128)
-            # Replace QWK's EOL characters with current standards.
-            body = body.replace(chr(227), '\r\n')
-            # Discard null bytes. For some reason strip() doesn't do it.
-            body = body.replace(chr(0), '')
-
-            message = QwkMessage(headers['status'], headers['number'],
-                headers['date'], headers['time'], headers['to'],
-                headers['from'], headers['subject'],
-                headers['password'], headers['reference'],
-                headers['forum'], body)
+        for message in self.iter_messages():
             messages.append(message)
-            self.forums[headers['forum']]['messages'].append(message)
-
-            # Loop all over again.
-            block = file.read(128)
+            self.forums[message.forum]['messages'].append(message)
         self.messages = messages
 
+    def iter_messages(self):
+        """
+        Yields messages out of MESSAGES.DAT one at a time. The file is
+        memory mapped if the packet is unpacked, or else streamed from
+        the packet in chunks, so memory use does not grow with the size
+        of the packet.
+        """
+        if self._unpacked():
+            file = open(os.path.join(self.packet, 'MESSAGES.DAT'), 'rb')
+            try:
+                if os.fstat(file.fileno()).st_size <= 128:
+                    return
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                file.close()
+            # Skip the copyright header
+            offsets, end = self._scanHeaders(data, True, 128)
+            for x in range(0, len(offsets), self.batch_size):
+                for message in self._decodeMessages(data,
+                                    offsets[x:x+self.batch_size]):
+                    yield message
+            return
+
+        zip = ZipFile(self.packet, 'r')
+        try:
+            file = zip.open('MESSAGES.DAT')
+            file.read(128) # Skip the copyright header
+
+            data = ''
+            end = 0
+            eof = False
+            while not eof:
+                chunk = file.read(self.chunk_size)
+                eof = chunk == ''
+                data = data[end:] + chunk
+                offsets, end = self._scanHeaders(data, eof)
+                for message in self._decodeMessages(data, offsets):
+                    yield message
+            file.close()
+        finally:
+            zip.close()
+
+    def forum_messages(self, forum):
+        """
+        Returns the messages of one forum, reading only those messages
+        out of MESSAGES.DAT.
+        """
+        self._loadIndex()
+        return list(self._readAt(self._forumOffsets.get(forum, [])))
+
+    def message_at(self, index):
+        """
+        Returns the message at the given position in MESSAGES.DAT,
+        counting from 0, reading only that message.
+        """
+        self._loadIndex()
+        return list(self._readAt([self._offsets[index]]))[0]
+
+    def _loadIndex(self):
+        """
+        Finds where each message is in MESSAGES.DAT, from the packet's
+        NDX files if they can be trusted, or else by hopping from header
+        to header without decoding the messages.
+        """
+        if self._offsets is not None:
+            return
+        forums = self._readIndex()
+        if forums is None:
+            forums = {}
+            for offset, forum in self._scanForums():
+                forums.setdefault(forum, []).append(offset)
+        self._forumOffsets = forums
+        self._offsets = sorted([offset for offsets in forums.values()
+                                for offset in offsets])
+
+    def _readIndex(self):
+        """
+        Reads the NNN.NDX files of an unpacked packet into a dict mapping
+        forum numbers to lists of message offsets. Returns None unless
+        the packet has NDX files and they point at every message header
+        in MESSAGES.DAT, each in the forum of its NDX file. The NDX files
+        of a Zip packet are not used, as checking them would mean
+        decompressing all of MESSAGES.DAT, which is as much work as
+        finding the messages without them.
+        """
+        if not self._unpacked():
+            return None
+        forums = {}
+        try:
+            for name in os.listdir(self.packet):
+                base, extension = os.path.splitext(name)
+                if extension.upper() != '.NDX' or not base.isdigit():
+                    continue
+                file = open(os.path.join(self.packet, name), 'rb')
+                try:
+                    data = file.read()
+                finally:
+                    file.close()
+                # Record numbers count blocks from 1
+                forums[int(base)] = sorted([(int(unmsbin(data[x:x+4])) - 1) * 128
+                                            for x in range(0, len(data) - 4, 5)])
+        except (ValueError, OverflowError):
+            # Not a number
+            return None
+        if not forums:
+            return None
+
+        file = open(os.path.join(self.packet, 'MESSAGES.DAT'), 'rb')
+        try:
+            if os.fstat(file.fileno()).st_size <= 128:
+                return None
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        # Each message must start where the one before it ends, from the
+        # first after the copyright header to the last in the file
+        expected = 128
+        for offset, forum in sorted([(offset, forum) for forum in forums
+                                     for offset in forums[forum]]):
+            if offset != expected or offset + 128 > len(data):
+                return None
+            if struct.unpack('<H', data[offset+123:offset+125])[0] != forum:
+                return None
+            try:
+                blocks = int(data[offset+116:offset+122].strip(PADDING) or 0)
+            except ValueError:
+                return None
+            expected = offset + 128 * max(blocks, 1)
+        if expected + 128 <= len(data):
+            # Messages left out of the index
+            return None
+        return forums
+
+    def _scanForums(self):
+        """
+        Yields the offset and forum number of each message header in
+        MESSAGES.DAT, without decoding the messages.
+        """
+        if self._unpacked():
+            file = open(os.path.join(self.packet, 'MESSAGES.DAT'), 'rb')
+            try:
+                if os.fstat(file.fileno()).st_size <= 128:
+                    return
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                file.close()
+            offsets, end = self._scanHeaders(data, True, 128)
+            for offset in offsets:
+                yield offset, struct.unpack('<H', data[offset+123:offset+125])[0]
+            return
+
+        zip = ZipFile(self.packet, 'r')
+        try:
+            file = zip.open('MESSAGES.DAT')
+            file.read(128) # Skip the copyright header
+            # Offset in MESSAGES.DAT of the start of data
+            base = 128
+            data = ''
+            end = 0
+            eof = False
+            while not eof:
+                chunk = file.read(self.chunk_size)
+                eof = chunk == ''
+                base += end
+                data = data[end:] + chunk
+                offsets, end = self._scanHeaders(data, eof)
+                for offset in offsets:
+                    yield base + offset, struct.unpack('<H', data[offset+123:offset+125])[0]
+            file.close()
+        finally:
+            zip.close()
+
+    def _readAt(self, offsets):
+        """
+        Yields the messages at the given offsets of MESSAGES.DAT, which
+        must be in ascending order. Messages in an unpacked packet are
+        read straight from where they are; in a Zip file, the data in
+        between has to be decompressed but is not decoded.
+        """
+        if self._unpacked():
+            file = open(os.path.join(self.packet, 'MESSAGES.DAT'), 'rb')
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                file.close()
+            for x in range(0, len(offsets), self.batch_size):
+                for message in self._decodeMessages(data,
+                                    offsets[x:x+self.batch_size]):
+                    yield message
+            return
+
+        zip = ZipFile(self.packet, 'r')
+        try:
+            file = zip.open('MESSAGES.DAT')
+            position = 0
+            for offset in offsets:
+                # Skip ahead to the message
+                while position < offset:
+                    skipped = len(file.read(min(offset - position, self.chunk_size)))
+                    if not skipped:
+                        return
+                    position += skipped
+                header = file.read(128)
+                blocks = max(int(header[116:122].strip(PADDING) or 0), 1)
+                data = header + file.read(128 * (blocks - 1))
+                position += len(data)
+                for message in self._decodeMessages(data, [0]):
+                    yield message
+            file.close()
+        finally:
+            zip.close()
+
+    def _decodeMessages(self, data, offsets):
+        """
+        Yields a QwkMessage for each message at the given offsets of
+        data. Bodies are passed on as buffers over data, without
+        copying.
+        """
+        for offset, headers in izip(offsets, self._decodeHeaders(data, offsets)):
+            (status, number, date, time, mto, mfrom, subject, password,
+                reference, blocks, forum) = headers
+            rawbody = buffer(data, offset+128, 128*(max(blocks, 1)-1))
+            yield QwkMessage(status, number, date, time, mto, mfrom,
+                subject, password, reference, forum, rawbody=rawbody)
+
+class QwkWriter:
+    """
+    Writes a QWK packet. Add the forums with add_forum() and the
+    messages with add_message(), then call close() to write the packet
+    out to the packet parameter, a file name or a seekable file like
+    object. Messages are written to a temporary file as they are added,
+    so the packet is never held in memory.
+    """
+
+    # MESSAGES.DAT header record, as written. See commented area above.
+    record_layout = '<c7s8s5s25s25s25s12s8s6scHHc'
+
+    def __init__(self, packet, bbsid, bbsname):
+        self.packet = packet
+        self.bbsid = bbsid
+        self.bbsname = bbsname
+        self.forums = {}
+        self.count = 0
+        # Block numbers of each forum's messages, for the NDX files
+        self._index = {}
+        self._messages = tempfile.NamedTemporaryFile()
+        self._messages.write('Produced by QwkWeb'.ljust(128))
+        self._blocks = 1
+
+    def add_forum(self, number, title):
+        """
+        Adds a forum to the packet's forum list.
+        """
+        self.forums[number] = title
+
+    def add_message(self, message):
+        """
+        Adds a QwkMessage to the packet. Its text must be in the QWK
+        character set.
+        """
+        body = message.body.replace('\r\n', '\n').replace('\n', chr(227))
+        if body and not body.endswith(chr(227)):
+            body += chr(227)
+        blocks = max((len(body) + 127) // 128, 1) + 1
+        body = body.ljust((blocks - 1) * 128)
+        self.count += 1
+        self._messages.write(struct.pack(self.record_layout,
+            message.status or ' ', str(message.number).ljust(7)[:7],
+            message.date.ljust(8)[:8], message.time.ljust(5)[:5],
+            message.mto.ljust(25)[:25], message.mfrom.ljust(25)[:25],
+            message.subject.ljust(25)[:25], message.password.ljust(12)[:12],
+            str(message.reference or '').ljust(8)[:8], str(blocks).ljust(6),
+            chr(225), message.forum, self.count & 0xffff, ' '))
+        self._messages.write(body)
+        self._index.setdefault(message.forum, []).append(self._blocks + 1)
+        self._blocks += blocks
+
+    def _controlDat(self):
+        """
+        Returns the contents of CONTROL.DAT.
+        """
+        lines = [self.bbsname, '', '', '', '0,%s' % self.bbsid.upper(),
+                 time.strftime('%m-%d-%Y,%H:%M:%S'), '', '', '0',
+                 str(self.count), str(len(self.forums) - 1)]
+        for number in sorted(self.forums):
+            lines.extend([str(number), self.forums[number]])
+        lines.extend(['HELLO', 'NEWS', 'GOODBYE'])
+        return '\r\n'.join(lines) + '\r\n'
+
+    def close(self):
+        """
+        Writes out the packet and removes the temporary file.
+        """
+        self._messages.flush()
+        zip = ZipFile(self.packet, 'w', ZIP_DEFLATED)
+        try:
+            zip.writestr('CONTROL.DAT', self._controlDat())
+            zip.write(self._messages.name, 'MESSAGES.DAT')
+            for forum in sorted(self._index):
+                zip.writestr('%03d.NDX' % forum, ''.join(
+                    [msbin(block) + chr(forum & 0xff)
+                     for block in self._index[forum]]))
+        finally:
+            zip.close()
+            self._messages.close()
+
 
 if __name__=='__main__':
     # Testing here.
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# QwkWeb benchmarks.
+
+"""
+Benchmarks for QwkWeb, run against synthetic QWK packets. A packet with
+the requested number of messages, body size, forums and reply depth is
+generated, then timed through each stage:
+
+* parse: reading the packet with QwkPacket.
+* import: loading it into a fresh SQLite database built from sqlite.sql.
+* search: search queries, as latency percentiles.
+* pages: each page of the web interface, as latency percentiles.
+
+Results are written as JSON, so that runs can be compared. Run it from
+the folder the web interface runs from, as it renders pages with the
+templates there:
+
+  python qwkbench.py --messages 20000 --output before.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import shutil
+import sqlite3
+import platform
+import tempfile
+import optparse
+import ConfigParser
+from qwk import QwkMessage, QwkPacket, QwkWriter
+from qwkimport import PacketImporter
+import qwkbody
+import qwkdb
+
+# Syllables the words of generated messages are made of.
+SYLLABLES = ['ba', 'ko', 'ri', 'tel', 'mon', 'sa', 'dur', 'vex', 'lin', 'po',
+             'qua', 'zen', 'fi', 'ost', 'um', 'gar', 'hex', 'ne', 'tri', 'wo']
+
+
+def percentiles(timings):
+    """
+    Summarizes a list of timings in seconds as milliseconds.
+    """
+    timings = sorted(timings)
+    def at(fraction):
+        return round(timings[int(round((len(timings) - 1) * fraction))] * 1000, 3)
+    return {'count': len(timings), 'p50': at(0.5), 'p90': at(0.9),
+            'p99': at(0.99), 'max': at(1.0),
+            'mean': round(sum(timings) / len(timings) * 1000, 3)}
+
+
+class PacketGenerator:
+    """
+    Makes synthetic QWK packets. Words are drawn from a made up
+    vocabulary with a long tail, so that searches for common and rare
+    words both have something to find. Each message starts a thread or
+    replies to an earlier message in its forum, with threads no deeper
+    than depth.
+    """
+    def __init__(self, messages=10000, bodysize=1000, forums=10, depth=8,
+                 users=100, seed=0):
+        self.messages = messages
+        self.bodysize = bodysize
+        self.forums = forums
+        self.depth = depth
+        self.random = random.Random(seed)
+        self.vocabulary = [''.join(self.random.sample(SYLLABLES, self.random.randint(1, 3)))
+                           for x in range(5000)]
+        self.users = ['%s %s' % (self.word(), self.word()) for x in range(users)]
+
+    def word(self):
+        """
+        Returns a random word, common words being far likelier.
+        """
+        return self.vocabulary[int(self.random.paretovariate(1.0)) % len(self.vocabulary)]
+
+    def body(self):
+        """
+        Returns a message body of about bodysize bytes, in lines of up
+        to 72 characters.
+        """
+        size = int(self.random.uniform(0.5, 1.5) * self.bodysize)
+        lines = []
+        line = []
+        length = 0
+        while length < size:
+            word = self.word()
+            line.append(word)
+            length += len(word) + 1
+            if len(' '.join(line)) > 72:
+                lines.append(' '.join(line))
+                line = []
+        lines.append(' '.join(line))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """
+        Writes a packet to path.
+        """
+        writer = QwkWriter(path, 'BENCH', 'QwkWeb Benchmark BBS')
+        for forum in range(1, self.forums + 1):
+            writer.add_forum(forum, 'Forum %d' % forum)
+        # Message number, subject and depth of recent messages per forum
+        recent = dict([(forum, []) for forum in range(1, self.forums + 1)])
+        for number in range(1, self.messages + 1):
+            forum = self.random.randint(1, self.forums)
+            candidates = [entry for entry in recent[forum][-50:] if entry[2] < self.depth]
+            if candidates and self.random.random() < 0.7:
+                reference, subject, depth = self.random.choice(candidates)
+                depth += 1
+                subject = subject.startswith('Re: ') and subject or 'Re: ' + subject
+            else:
+                reference, depth = 0, 0
+                subject = ' '.join([self.word() for x in range(3)]).capitalize()
+            recent[forum].append((number, subject, depth))
+            day = number * 1000 // self.messages
+            writer.add_message(QwkMessage(' ', number,
+                '%02d-%02d-95' % (day // 28 % 12 + 1, day % 28 + 1),
+                '%02d:%02d' % (number // 60 % 24, number % 60),
+                self.random.choice(self.users).upper(),
+                self.random.choice(self.users).upper(),
+                subject[:25], '', reference, forum, body=self.body()))
+        writer.close()
+
+
+class Benchmark:
+    """
+    Times the stages of QwkWeb on a generated packet, in a temporary
+    folder that is removed afterwards.
+    """
+    def __init__(self, generator, repeat=50, compress=False):
+        self.generator = generator
+        self.repeat = repeat
+        self.compress = compress
+        self.folder = tempfile.mkdtemp(prefix='qwkbench')
+        self.packet = os.path.join(self.folder, 'BENCH.QWK')
+        self.database = os.path.join(self.folder, 'qwkweb.db')
+        self.results = {}
+
+    def run(self):
+        """
+        Runs all benchmarks. Returns the results.
+        """
+        try:
+            started = time.time()
+            self.generator.write(self.packet)
+            self.results['generate'] = {'seconds': round(time.time() - started, 3),
+                                        'bytes': os.path.getsize(self.packet)}
+            self.benchParse()
+            self.benchImport()
+            self.loadApplication()
+            self.benchSearch()
+            self.benchPages()
+        finally:
+            shutil.rmtree(self.folder)
+        return self.results
+
+    def benchParse(self):
+        """
+        Times reading every message, eagerly and streamed.
+        """
+        results = {}
+        started = time.time()
+        count = len(QwkPacket(self.packet).messages)
+        results['eager'] = self._rate(count, time.time() - started)
+        started = time.time()
+        count = 0
+        for message in QwkPacket(self.packet, eager=False).iter_messages():
+            message.ubody
+            count += 1
+        results['stream_decoded'] = self._rate(count, time.time() - started)
+        packet = QwkPacket(self.packet, eager=False)
+        started = time.time()
+        packet.forum_messages(1)
+        results['one_forum_seconds'] = round(time.time() - started, 3)
+        self.results['parse'] = results
+
+    def benchImport(self):
+        """
+        Times importing the packet into a new database, compressing
+        bodies against a dictionary trained on its first messages if
+        asked to.
+        """
+        con = sqlite3.connect(self.database)
+        con.executescript(open('sqlite.sql').read())
+        con.close()
+        con = qwkdb.connect(self.database, ConfigParser.ConfigParser())
+        if self.compress:
+            messages = QwkPacket(self.packet, eager=False).iter_messages()
+            qwkbody.addDictionary(con, qwkbody.train(
+                [message.ubody for message in itertools.islice(messages, 5000)]))
+            con.commit()
+        started = time.time()
+        stats = PacketImporter(con).importPacket(QwkPacket(self.packet, eager=False))
+        elapsed = time.time() - started
+        con.close()
+        self.results['import'] = self._rate(sum([stats[forum]['inserted']
+                                                 for forum in stats]), elapsed)
+        self.results['import']['database_bytes'] = os.path.getsize(self.database)
+
+    def loadApplication(self):
+        """
+        Points the web application at the benchmark database, with the
+        page cache off so that every request is rendered.
+        """
+        import web
+        web.config.debug = False
+        import qwkweb
+        from qwkcache import ResponseCache
+        config = ConfigParser.ConfigParser()
+        config.add_section('qwkweb')
+        config.set('qwkweb', 'dbn', 'sqlite')
+        config.set('qwkweb', 'db', self.database)
+        qwkweb.db = qwkdb.database(config)
+        qwkweb.cache = ResponseCache(0)
+        self.app = qwkweb.app
+        self.authorization = 'Basic ' + 'archives:archives'.encode('base64').strip()
+
+    def request(self, path):
+        """
+        Requests a page. Returns the time it took in seconds.
+        """
+        started = time.time()
+        response = self.app.request(path, env={'HTTP_AUTHORIZATION': self.authorization})
+        elapsed = time.time() - started
+        if not response.status.startswith('200'):
+            raise ValueError('%s: %s' % (path, response.status))
+        return elapsed
+
+    def benchSearch(self):
+        """
+        Times search queries for common and rare words, phrases, word
+        prefixes and authors.
+        """
+        vocabulary = self.generator.vocabulary
+        author = self.generator.users[0].split()[0]
+        queries = {'common_word': 'body=%s' % vocabulary[1],
+                   'rare_word': 'body=%s' % vocabulary[-1],
+                   'two_words': 'body=%s+%s' % (vocabulary[2], vocabulary[3]),
+                   'prefix': 'body=%s*' % vocabulary[1][:2],
+                   'author': 'mfrom=%s' % author,
+                   'by_date': 'body=%s&order=mdate' % vocabulary[1],
+                   'all': 'order=mdate'}
+        self.results['search'] = dict([(name, percentiles(
+            [self.request('/search?' + query) for x in range(self.repeat)]))
+            for name, query in queries.items()])
+
+    def benchPages(self):
+        """
+        Times each kind of page, spread over the archive.
+        """
+        con = sqlite3.connect(self.database)
+        messages = [row[0] for row in con.execute('SELECT id FROM message WHERE forumid = 1')]
+        roots = [row[0] for row in con.execute('SELECT id FROM thread '
+                                               'WHERE forumid = 1 AND root = id')]
+        con.close()
+        pick = random.Random(0).choice
+        routes = {'index': lambda: '/',
+                  'board': lambda: '/bench',
+                  'forum': lambda: '/bench/1',
+                  'forum_by_date': lambda: '/bench/1?order=mdate',
+                  'forum_large_page': lambda: '/bench/1?size=1000',
+                  'message': lambda: '/bench/1/%d' % pick(messages),
+                  'thread': lambda: '/bench/1/thread/%d' % pick(roots),
+                  'export': lambda: '/bench/1/export.qwk?since=%d' % messages[-100]}
+        self.results['pages'] = dict([(name, percentiles(
+            [self.request(route()) for x in range(self.repeat)]))
+            for name, route in routes.items()])
+
+    def _rate(self, count, elapsed):
+        return {'messages': count, 'seconds': round(elapsed, 3),
+                'messages_per_second': round(count / max(elapsed, 0.000001), 1)}
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-m', '--messages', type='int', default=10000,
+                      help='messages in the packet (default: 10000)')
+    parser.add_option('-b', '--body', type='int', default=1000,
+                      help='average body size in bytes (default: 1000)')
+    parser.add_option('-f', '--forums', type='int', default=10,
+                      help='number of forums (default: 10)')
+    parser.add_option('-d', '--depth', type='int', default=8,
+                      help='deepest reply chain (default: 8)')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='random seed (default: 0)')
+    parser.add_option('-r', '--repeat', type='int', default=50,
+                      help='requests per search and page (default: 50)')
+    parser.add_option('-z', '--compress', action='store_true', default=False,
+                      help='store message bodies compressed')
+    parser.add_option('-o', '--output', default='-',
+                      help='file to write the results to (default: standard output)')
+    parser.add_option('-p', '--packet',
+                      help='only write a packet to this file, without benchmarking')
+    options, args = parser.parse_args(argv[1:])
+    generator = PacketGenerator(options.messages, options.body, options.forums,
+                                options.depth, seed=options.seed)
+    if options.packet:
+        generator.write(options.packet)
+        return 0
+
+    results = {'parameters': {'messages': options.messages, 'body': options.body,
+                              'forums': options.forums, 'depth': options.depth,
+                              'seed': options.seed, 'repeat': options.repeat,
+                              'compress': options.compress},
+               'environment': {'python': platform.python_version(),
+                               'sqlite': sqlite3.sqlite_version,
+                               'platform': platform.platform()},
+               'started': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    results.update(Benchmark(generator, options.repeat, options.compress).run())
+    if options.output == '-':
+        output = sys.stdout
+    else:
+        output = open(options.output, 'wb')
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if output is not sys.stdout:
+        output.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
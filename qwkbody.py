@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# QwkWeb message body compression.
+
+"""
+Compressed storage of message bodies. QWK bodies are mostly plain text
+with a lot in common between messages: quoting, taglines, tear and
+origin lines. Compressing each body on its own gains little on short
+messages, so bodies are compressed against a dictionary of text that
+recurs across the archive, trained by qwkcompress.py and kept in the
+bodydict table.
+
+A compressed body is stored as a BLOB: one byte holding the id of its
+dictionary, then deflate data that carries on from the dictionary as if
+it had been compressed just before. Uncompressed bodies are stored as
+TEXT, so both can be in the database at once. SQLite connections opened
+through qwkdb get two functions for them:
+
+* qwkbody(body) returns the text of a stored body, compressed or not.
+* qwkcompress(text) returns text compressed with the newest dictionary,
+  or unchanged if there are no dictionaries or it would not be smaller.
+"""
+
+import re
+import zlib
+import sqlite3
+
+# Largest dictionary trained, in bytes. Deflate refers back at most 32
+# KiB, so the bigger the dictionary the less of a long body can use it.
+DICTSIZE = 16384
+
+# Recurring text worth putting in a dictionary: whole lines and words,
+# with what follows them.
+pieces = re.compile(r'[^\n]{4,}\n|\S{4,}\s')
+
+
+def train(bodies, size=DICTSIZE):
+    """
+    Makes a dictionary of up to size bytes out of the lines and words
+    that recur in the most sample bodies, given as unicode. Pieces are
+    scored by the bytes they would save, and the best are put last, as
+    those are the closest to the body and cheapest to refer to.
+    """
+    counts = {}
+    for body in bodies:
+        for piece in set(pieces.findall(body.encode('utf-8'))):
+            counts[piece] = counts.get(piece, 0) + 1
+    scored = sorted([((count - 1) * len(piece), piece)
+                     for piece, count in counts.items() if count > 1], reverse=True)
+    chosen = []
+    length = 0
+    for score, piece in scored:
+        if length + len(piece) > size:
+            continue
+        chosen.append(piece)
+        length += len(piece)
+    chosen.reverse()
+    return ''.join(chosen)
+
+def prime(dictionary):
+    """
+    Returns a compressor and a decompressor that have been through the
+    dictionary, for copies of them to carry on from.
+    """
+    compressor = zlib.compressobj()
+    # Flush to a byte boundary so that the data that follows can be
+    # stored on its own
+    prefix = compressor.compress(dictionary) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    decompressor = zlib.decompressobj()
+    decompressor.decompress(prefix)
+    return compressor, decompressor
+
+def addDictionary(con, dictionary):
+    """
+    Stores a new dictionary, which the importers will compress bodies
+    with from then on. Returns its id.
+    """
+    cur = con.cursor()
+    cur.execute('INSERT INTO bodydict (data) VALUES (?)', (buffer(dictionary),))
+    if cur.lastrowid > 255:
+        raise ValueError('No more than 255 dictionaries can be stored.')
+    return cur.lastrowid
+
+
+class BodyCodec:
+    """
+    Compresses and decompresses bodies for one SQLite connection, with
+    the dictionaries in its bodydict table. Dictionaries are read when
+    first needed, and again when a body refers to one not seen yet.
+    """
+    def __init__(self, con):
+        self.con = con
+        self.primed = {}
+        self.current = None
+        self.loaded = False
+
+    def _load(self):
+        try:
+            rows = self.con.execute('SELECT id, data FROM bodydict ORDER BY id').fetchall()
+        except sqlite3.OperationalError:
+            # Database from before compression
+            rows = []
+        for id, data in rows:
+            if id not in self.primed:
+                self.primed[id] = prime(str(data))
+        self.current = rows and rows[-1][0] or None
+        self.loaded = True
+
+    def compress(self, text):
+        """
+        Returns text compressed with the newest dictionary, or text
+        itself if there is none or compressing does not make it smaller.
+        """
+        if not self.loaded:
+            self._load()
+        if self.current is None or text is None:
+            return text
+        data = text.encode('utf-8')
+        compressor = self.primed[self.current][0].copy()
+        compressed = chr(self.current) + compressor.compress(data) + compressor.flush()
+        if len(compressed) >= len(data):
+            return text
+        return buffer(compressed)
+
+    def decompress(self, body):
+        """
+        Returns the text of a stored body.
+        """
+        if not isinstance(body, buffer):
+            return body
+        data = str(body)
+        id = ord(data[0])
+        if id not in self.primed:
+            self._load()
+            if id not in self.primed:
+                raise ValueError('Body compressed with unknown dictionary %d' % id)
+        return self.primed[id][1].copy().decompress(data[1:]).decode('utf-8')
+
+
+def register(con):
+    """
+    Adds the qwkbody() and qwkcompress() functions to an SQLite
+    connection. Returns the connection.
+    """
+    codec = BodyCodec(con)
+    con.create_function('qwkbody', 1, codec.decompress)
+    con.create_function('qwkcompress', 1, codec.compress)
+    return con
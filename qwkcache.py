@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# QwkWeb response cache.
+
+"""
+In-process cache of rendered QwkWeb pages. Archived messages only
+change when a packet is imported, so pages are cached against the
+generation counter of the board they show, which the importer bumps.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Least recently used cache of pages, bounded by the total length of
+    the pages held. Each page is stored with the generation it was
+    rendered for and is only returned while that is still current.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        """
+        Returns the page cached under key for the given generation, or
+        None. Pages from older generations are dropped.
+        """
+        with self.lock:
+            entry = self.pages.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] != generation:
+                self.size -= len(entry[1])
+                return None
+            # Re-insert to mark as most recently used
+            self.pages[key] = entry
+            return entry[1]
+
+    def put(self, key, generation, page):
+        """
+        Caches a page under key, evicting the least recently used pages
+        to stay within the size bound.
+        """
+        if len(page) > self.maxsize:
+            return
+        with self.lock:
+            old = self.pages.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.pages[key] = (generation, page)
+            self.size += len(page)
+            while self.size > self.maxsize:
+                oldkey, (oldgeneration, oldpage) = self.pages.popitem(last=False)
+                self.size -= len(oldpage)
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        with self.lock:
+            self.pages.clear()
+            self.size = 0
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# QwkWeb body compression.
+
+"""
+Compresses the message bodies of a QwkWeb SQLite database in place.
+A dictionary of text that recurs across the archive is trained from a
+sample of messages and stored in the database, and the bodies are then
+compressed against it in batches, each committed on its own so that the
+web interface can carry on reading meanwhile. An interrupted run carries
+on where it stopped when run again. From then on the importers compress
+new messages too. Databases made before compression was added need
+migrations/07-compressed-bodies.sql first.
+
+  python qwkcompress.py qwkweb.db
+
+Compressed bodies free pages inside the database file; --vacuum gives
+them back to the file system afterwards.
+"""
+
+import sys
+import time
+import optparse
+import sqlite3
+import qwkbody
+import qwkdb
+
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] database',
+        description='Compresses the message bodies in a QwkWeb database.')
+    parser.add_option('-b', '--batch', type='int', default=5000,
+                      help='messages compressed per transaction (default: 5000)')
+    parser.add_option('-s', '--sample', type='int', default=5000,
+                      help='messages the dictionary is trained on (default: 5000)')
+    parser.add_option('-t', '--train', action='store_true', default=False,
+                      help='train a new dictionary and compress all bodies with it, '
+                           'even if they were compressed before')
+    parser.add_option('-v', '--vacuum', action='store_true', default=False,
+                      help='shrink the database file afterwards')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('a database is required')
+
+    con = qwkdb.connect(args[0])
+    try:
+        dictionaries = con.execute('SELECT max(id) FROM bodydict').fetchone()[0]
+    except sqlite3.OperationalError:
+        parser.error('the database needs migrations/07-compressed-bodies.sql first')
+
+    if dictionaries is None or options.train:
+        print >> sys.stderr, "Training a dictionary on %d messages..." % options.sample
+        # Pick the sample before decompressing, so that only its
+        # bodies are decompressed
+        bodies = [row[0] for row in con.execute(
+            'SELECT qwkbody(body) FROM message WHERE rowid IN '
+            '(SELECT rowid FROM message ORDER BY random() LIMIT ?)', (options.sample,))]
+        dictionary = qwkbody.addDictionary(con, qwkbody.train(bodies))
+        con.commit()
+    else:
+        dictionary = dictionaries
+    # The connection read the dictionaries before this one was added
+    qwkbody.register(con)
+
+    # Compress bodies that are not compressed with the dictionary yet,
+    # a range of rowids at a time
+    before = con.execute('SELECT total(length(CAST(body AS BLOB))) FROM message').fetchone()[0]
+    maxrowid = con.execute('SELECT max(rowid) FROM message').fetchone()[0] or 0
+    started = time.time()
+    lastrowid = 0
+    while lastrowid < maxrowid:
+        con.execute('UPDATE message SET body = qwkcompress(qwkbody(body)) '
+                    'WHERE rowid > ? AND rowid <= ? AND '
+                    '(typeof(body) = \'text\' OR hex(substr(body, 1, 1)) != ?)',
+                    (lastrowid, lastrowid + options.batch, '%02X' % dictionary))
+        con.commit()
+        lastrowid += options.batch
+        print >> sys.stderr, "\r%d%% done (%.0f rows/s)" % (
+            min(lastrowid, maxrowid) * 100 / maxrowid,
+            min(lastrowid, maxrowid) / max(time.time() - started, 0.001)),
+    print >> sys.stderr
+    after = con.execute('SELECT total(length(CAST(body AS BLOB))) FROM message').fetchone()[0]
+    print >> sys.stderr, "Bodies take %.1f MB, down from %.1f MB." % (
+        after / 1048576, before / 1048576)
+
+    if options.vacuum:
+        # VACUUM may renumber the message rowids the search index is
+        # keyed on, so the index is built again.
+        print >> sys.stderr, "Vacuuming..."
+        con.execute('VACUUM')
+        con.execute("INSERT INTO message_fts (message_fts) VALUES ('rebuild')")
+        con.commit()
+    con.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# QwkWeb database connections.
+
+"""
+Opens QwkWeb databases as configured in qwkweb.conf. SQLite connections
+get the PRAGMA settings in the [sqlite] section applied as they are
+opened. web.py keeps one connection per thread and reuses it for the
+life of the thread, so these are paid for once per server thread rather
+than once per request. By default databases are put in write-ahead log
+mode, which lets pages be read while a packet import is being written.
+
+Queries made by the web interface are timed for the metrics, and those
+slower than the slowquery setting in the [metrics] section are logged
+with their query plan.
+"""
+
+import os
+import re
+import time
+import ConfigParser
+import sqlite3
+import web
+import qwkbody
+import qwkmetrics
+
+# Configuration files, in the order they are read.
+CONFIGFILES = ['.qwkweb.conf', os.path.expanduser('~/.qwkweb.conf'),
+               '/etc/qwkweb.conf']
+
+# Settings used unless the [sqlite] section says otherwise.
+PRAGMAS = {'busy_timeout': '5000',
+           'journal_mode': 'wal',
+           'synchronous': 'normal'}
+
+
+def readConfig():
+    """
+    Returns a ConfigParser holding the QwkWeb configuration.
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(CONFIGFILES)
+    return config
+
+def pragmas(config):
+    """
+    Returns the PRAGMA settings in a configuration as a list of name,
+    value pairs. busy_timeout comes first so that the others wait for
+    locks held by other connections.
+    """
+    settings = dict(PRAGMAS)
+    if config.has_section('sqlite'):
+        settings.update(config.items('sqlite'))
+    settings.pop('readonly', None)
+    for name, value in settings.items():
+        if not re.match(r'^[a-z_]+$', name) or not re.match(r'^[-\w]+$', value):
+            raise ValueError('Invalid SQLite setting: %s = %s' % (name, value))
+    return sorted(settings.items(), key=lambda (name, value): (name != 'busy_timeout', name))
+
+def setup(con, settings, readonly=False):
+    """
+    Applies PRAGMA settings to an SQLite connection and adds the
+    functions for compressed bodies. Returns the connection.
+    """
+    qwkbody.register(con)
+    for name, value in settings:
+        con.execute('PRAGMA %s = %s' % (name, value))
+    if readonly:
+        con.execute('PRAGMA query_only = 1')
+    return con
+
+def connect(database, config=None):
+    """
+    Opens an SQLite database file with the configured settings, for use
+    outside web.py, such as by the importers.
+    """
+    if config is None:
+        config = readConfig()
+    return setup(sqlite3.connect(database), pragmas(config))
+
+
+class SqliteDB(web.db.SqliteDB):
+    """
+    web.py SQLite database that applies PRAGMA settings to each new
+    connection, and can make connections read only. Queries are timed
+    for the metrics, and logged with their query plan if they take over
+    slowquery seconds.
+    """
+    def __init__(self, settings=(), readonly=False, slowquery=None, **keywords):
+        self.settings = settings
+        self.readonly = readonly
+        self.slowquery = slowquery
+        web.db.SqliteDB.__init__(self, **keywords)
+
+    def _connect(self, keywords):
+        return setup(web.db.SqliteDB._connect(self, keywords), self.settings, self.readonly)
+
+    def _db_execute(self, cur, sql_query):
+        # SQLite runs a query up to its first row when executed and the
+        # rest as rows are fetched, so this is the time to the first
+        # row. For sorted results that includes the sort.
+        started = time.time()
+        out = web.db.SqliteDB._db_execute(self, cur, sql_query)
+        elapsed = time.time() - started
+        query, params = self._process_query(sql_query)
+        slow = self.slowquery is not None and elapsed > self.slowquery
+        qwkmetrics.recordQuery(query, elapsed, slow)
+        if slow:
+            self._logSlowQuery(query, params, elapsed)
+        return out
+
+    def _logSlowQuery(self, query, params, elapsed):
+        """
+        Logs a slow query with its query plan.
+        """
+        lines = ['Slow query (%.3fs, %s): %s' % (elapsed, qwkmetrics.route() or '-',
+                                                 ' '.join(query.split()))]
+        try:
+            # A cursor of its own, as the query's rows are still to be
+            # fetched from the other.
+            plan = self.ctx.db.cursor()
+            plan.execute('EXPLAIN QUERY PLAN ' + query, params)
+            for row in plan.fetchall():
+                lines.append('  %s' % row[-1])
+        except sqlite3.Error, e:
+            lines.append('  No query plan: %s' % e)
+        print >> web.debug, u'\n'.join(lines).encode('utf-8')
+
+
+def database(config):
+    """
+    Opens the database named in the [qwkweb] section for the web
+    interface. SQLite connections are read only if the [sqlite] section
+    sets readonly, as the web interface leaves writing to the importers.
+    Queries are logged as slow if they take longer than the slowquery
+    setting of the [metrics] section, in seconds.
+    """
+    parameters = dict(config.items('qwkweb'))
+    if parameters.get('dbn') != 'sqlite':
+        return web.database(**parameters)
+    del parameters['dbn']
+    readonly = config.has_option('sqlite', 'readonly') and \
+        config.getboolean('sqlite', 'readonly')
+    slowquery = None
+    if config.has_option('metrics', 'slowquery'):
+        slowquery = config.getfloat('metrics', 'slowquery')
+    return SqliteDB(settings=pragmas(config), readonly=readonly, slowquery=slowquery,
+                    **parameters)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# QwkWeb static archive export.
+
+"""
+Exports the archive as a tree of static HTML pages with the same URLs
+as the web interface, so that it can be served by a plain file server
+and only search and upload need the web interface. Each page is stored
+as index.html in a directory named after its URL. Pages are rendered by
+the web interface itself, so run this from the folder it runs from:
+
+  python qwkexport.py /var/www/archive
+
+Forum listings are exported in each of their orders, one page of up to
+MAXSIZE messages after another. The listing in message number order is
+at the forum's URL, and the others in a by-<order> directory below it,
+which the column heading links are pointed at. Exports are incremental: the board
+generations and forum message counts seen are saved in the export, and
+only the boards and forums that changed since are rendered again. The
+pages are rendered by a pool of processes.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import urllib
+import optparse
+import multiprocessing
+from base64 import b64encode
+import qwkdb
+
+# Name of the file in the export holding what was exported.
+STATEFILE = '.qwkexport.json'
+
+# Pages rendered by a process at a time.
+CHUNK = 200
+
+# The archive's login, as checked by auth() in qwkweb.
+AUTHORIZATION = 'Basic ' + b64encode('archives:archives')
+
+# Pager links in forum listings.
+pagerlink = re.compile(r'href="(/[^"?]*)\?[^"]*&amp;(after|before)=([-\w=]*)"')
+
+# Column heading links to the listing in another order.
+orderlink = re.compile(r'href="(/[^"?]*)\?order=(\w+)"')
+
+# The web application, in each rendering process.
+_app = None
+_target = None
+
+def _initRenderer(target):
+    global _app, _target
+    import web
+    # Do not print every query
+    web.config.debug = False
+    import qwkweb
+    from qwkcache import ResponseCache
+    # Each page is only rendered once, so do not cache any.
+    qwkweb.cache = ResponseCache(0)
+    _app = qwkweb.app
+    _target = target
+
+
+def urlpath(*parts):
+    """
+    Joins board ids and numbers into a URL path.
+    """
+    return '/' + '/'.join([urllib.quote(unicode(part).encode('utf-8'), '')
+                           for part in parts])
+
+def render(path):
+    """
+    Renders a page of the web interface. Returns its HTML, or raises
+    ValueError if it could not be rendered.
+    """
+    response = _app.request(path, env={'HTTP_AUTHORIZATION': AUTHORIZATION})
+    if not response.status.startswith('200'):
+        raise ValueError('%s: %s' % (path, response.status))
+    return response.data
+
+def write(path, data):
+    """
+    Writes a page into the export, replacing any previous copy in one
+    step so that the file server never sends a partly written page.
+    """
+    filename = os.path.join(_target, urllib.unquote(path.lstrip('/')))
+    if not filename.endswith('.html'):
+        filename = os.path.join(filename, 'index.html')
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Made by another process meanwhile
+            pass
+    file = open(filename + '.tmp', 'wb')
+    try:
+        file.write(data)
+    finally:
+        file.close()
+    os.rename(filename + '.tmp', filename)
+
+def exportPages(paths):
+    """
+    Renders pages into the export. Returns the number of pages
+    written and a list of errors.
+    """
+    errors = []
+    for path in paths:
+        try:
+            write(path, render(path))
+        except Exception, e:
+            errors.append(str(e))
+    return len(paths) - len(errors), errors
+
+def listingpath(base, order):
+    """
+    Returns where the listing of a forum in the given order is exported.
+    """
+    if order == 'id':
+        return base
+    return '%s/by-%s' % (base, order)
+
+def exportListing(board, forum):
+    """
+    Renders all pages of a forum listing, in each of its orders, into
+    the export. Returns the number of pages written and a list of
+    errors.
+    """
+    from qwkweb import ForumIndex
+    count = 0
+    for order in sorted(ForumIndex.orders):
+        written, errors = exportOrder(board, forum, order)
+        count += written
+        if errors:
+            return count, errors
+    return count, []
+
+def exportOrder(board, forum, order):
+    """
+    Renders all pages of a forum listing in one order into the export.
+    The pager links, which take a cursor in the query string, are
+    pointed at the exported pages instead, and so are the column heading
+    links to the other orders. Returns the number of pages written and a
+    list of errors.
+    """
+    from qwkweb import MAXSIZE
+    base = urlpath(board, forum)
+    path = base + '?order=%s&size=%d' % (order, MAXSIZE)
+    filename = listingpath(base, order)
+    previous = None
+    count = 0
+    try:
+        while path:
+            data = render(path)
+            path = nextfile = None
+            for link, direction, cursor in pagerlink.findall(data):
+                if direction == 'after':
+                    path = '%s?order=%s&size=%d&after=%s' % (link, order, MAXSIZE, cursor)
+                    nextfile = '%s/after-%s.html' % (listingpath(link, order), cursor)
+            data = pagerlink.sub(lambda match: 'href="%s"' % (
+                match.group(2) == 'after' and nextfile or previous), data)
+            data = orderlink.sub(lambda match: 'href="%s"' % listingpath(
+                match.group(1), match.group(2)), data)
+            write(filename, data)
+            count += 1
+            previous, filename = filename, nextfile
+    except Exception, e:
+        return count, [str(e)]
+    return count, []
+
+def exportTask(task):
+    """
+    Runs one export task in a rendering process.
+    """
+    if task[0] == 'listing':
+        return exportListing(task[1], task[2])
+    return exportPages(task[1])
+
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] directory',
+        description='Exports the QwkWeb archive as static HTML pages. Only '
+                    'boards and forums changed since the last export into '
+                    'the directory are rendered again.')
+    parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count(),
+                      help='number of processes rendering pages '
+                           '(default: the number of CPUs)')
+    parser.add_option('-a', '--all', action='store_true', default=False,
+                      help='render all pages, changed or not')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('an export directory is required')
+    target = args[0]
+
+    config = qwkdb.readConfig()
+    if config.get('qwkweb', 'dbn') != 'sqlite':
+        parser.error('only SQLite databases can be exported')
+    con = qwkdb.connect(config.get('qwkweb', 'db'), config)
+    state = {'boards': {}, 'forums': {}}
+    statefile = os.path.join(target, STATEFILE)
+    if os.path.exists(statefile) and not options.all:
+        state = json.load(open(statefile, 'rb'))
+    boards = dict(con.execute('SELECT id, generation FROM board'))
+    forums = {}
+    for board, forum, mcount in con.execute('SELECT boardid, id, mcount FROM forum'):
+        forums['%s/%d' % (board, forum)] = (board, forum, mcount)
+
+    # Work out what changed, and the pages to render for it
+    changed = [board for board in boards if state['boards'].get(board) != boards[board]]
+    tasks = []
+    pages = []
+    if changed:
+        pages.append('/')
+    for board in changed:
+        pages.append(urlpath(board))
+    for key, (board, forum, mcount) in sorted(forums.items()):
+        if state['forums'].get(key) == mcount:
+            continue
+        tasks.append(('listing', board, forum))
+        for msgno, root in con.execute('SELECT id, root FROM thread '
+                                       'WHERE boardid = ? AND forumid = ? ORDER BY id',
+                                       (board, forum)):
+            pages.append(urlpath(board, forum, msgno))
+            if msgno == root:
+                pages.append(urlpath(board, forum, 'thread', msgno))
+    con.close()
+    for x in range(0, len(pages), CHUNK):
+        tasks.append(('pages', pages[x:x+CHUNK]))
+
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    if os.path.isdir(os.path.join(target, 'static')):
+        shutil.rmtree(os.path.join(target, 'static'))
+    shutil.copytree('static', os.path.join(target, 'static'))
+
+    pool = multiprocessing.Pool(options.jobs, _initRenderer, (target,))
+    started = time.time()
+    written = 0
+    failed = 0
+    try:
+        for count, errors in pool.imap_unordered(exportTask, tasks):
+            written += count
+            failed += len(errors)
+            for error in errors:
+                print >> sys.stderr, error
+            print >> sys.stderr, "\r%d pages written (%.0f pages/s)" % (
+                written, written / max(time.time() - started, 0.001)),
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    print >> sys.stderr
+
+    # Only remember what was exported if it all went well, so that
+    # anything that failed is tried again next time.
+    if failed:
+        print >> sys.stderr, "%d pages failed." % failed
+        return 1
+    state = {'boards': boards,
+             'forums': dict([(key, forums[key][2]) for key in forums])}
+    file = open(statefile + '.tmp', 'wb')
+    try:
+        json.dump(state, file)
+    finally:
+        file.close()
+    os.rename(statefile + '.tmp', statefile)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
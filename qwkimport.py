@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# QwkWeb packet importer.
+
+"""
+Bulk importer that loads messages from QWK packets into the QwkWeb
+database. Each packet is written in a single transaction, with messages
+inserted in batches. Duplicate messages are dropped by the message
+table's primary key instead of being looked up one at a time. The
+thread table, which holds each message's place in its thread and its
+neighbours in the forum, is kept up to date as messages arrive.
+
+Run as a script, it bulk loads packets into an SQLite database:
+
+  python qwkimport.py qwkweb.db packets/
+
+Packets are decoded in a pool of processes and written one at a time by
+the main process, holding the same writer lock as the queue workers. Each imported packet is logged by checksum in the
+packet table, and packets found there are skipped, so an interrupted
+import can be resumed by running it again.
+"""
+
+import os
+import sys
+import time
+import fcntl
+import hashlib
+import marshal
+import optparse
+import sqlite3
+import multiprocessing
+from qwk import QwkPacket, timestamp
+import qwkdb
+
+# Number of messages per executemany() call.
+BATCHSIZE = 500
+
+# Format of one message's step in a thread path. Sorting on the path
+# lists a thread depth first, with replies in message number order.
+PATHSTEP = '%07d/'
+
+
+class DecodedPacket:
+    """
+    The board, forums and public messages of a QwkPacket, decoded into
+    the rows the importer writes. Messages are decoded as they are read
+    unless load() or spool() is called first to decode them all up
+    front, so that the decoding can run alongside other imports before
+    the rows are written under the database's writer lock. The seconds
+    spent reading messages from the packet ('parse') and decoding their
+    fields ('decode') are added up in timings.
+    """
+    def __init__(self, qwk):
+        self.bbsid = unicode(qwk.bbsid.lower(), 'cp850')
+        self.bbsname = unicode(qwk.bbsname, 'cp850')
+        self.forums = dict([(forum, unicode(qwk.forums[forum]['title'], 'cp850'))
+                            for forum in qwk.forums])
+        self.private = dict.fromkeys(qwk.forums, 0)
+        self.timings = {'parse': 0.0, 'decode': 0.0}
+        self.messages = self._decodeMessages(qwk)
+
+    def _decodeMessages(self, qwk):
+        """
+        Yields a message table row for each public message, counting
+        the private messages per forum.
+        """
+        # Message fields are decoded when first read, so the time spent
+        # getting the next message is the parsing
+        started = time.time()
+        for message in qwk.iter_messages():
+            parsed = time.time()
+            self.timings['parse'] += parsed - started
+            if message.private:
+                self.private[message.forum] += 1
+                started = time.time()
+                continue
+            row = (message.number, message.forum, self.bbsid,
+                   message.udate, message.utime, message.umto,
+                   message.umfrom, message.reference,
+                   message.usubject, message.ubody)
+            self.timings['decode'] += time.time() - parsed
+            yield row
+            started = time.time()
+
+    def load(self):
+        """
+        Decodes all messages now. Returns the packet itself.
+        """
+        self.messages = list(self.messages)
+        return self
+
+    def spool(self, path):
+        """
+        Decodes all messages now into a file, from which they are read
+        back one at a time when imported, so that packets decoded ahead
+        of time are not held in memory. The number of messages is kept
+        in count. Returns the packet itself.
+        """
+        file = open(path, 'wb')
+        try:
+            self.count = 0
+            for row in self.messages:
+                marshal.dump(row, file)
+                self.count += 1
+        finally:
+            file.close()
+        self.messages = self._readSpool(path)
+        return self
+
+    def _readSpool(self, path):
+        file = open(path, 'rb')
+        try:
+            while True:
+                try:
+                    yield marshal.load(file)
+                except EOFError:
+                    return
+        finally:
+            file.close()
+
+
+class PacketImporter:
+    """
+    Imports QWK packets into the archive. The con parameter must be an
+    SQLite connection to the QwkWeb database opened with qwkdb.connect(),
+    which adds the functions that compress bodies. The seconds spent writing
+    messages ('insert'), threading them ('thread') and linking them to
+    their neighbours ('link') are added up in timings.
+    """
+    def __init__(self, con, batchsize=BATCHSIZE):
+        self.con = con
+        self.batchsize = batchsize
+        self.timings = {'insert': 0.0, 'thread': 0.0, 'link': 0.0}
+
+    def importPacket(self, qwk, progress=None):
+        """
+        Imports all public messages from a QwkPacket or DecodedPacket.
+        Returns a dict mapping forum numbers to dicts with the number of
+        'inserted', 'duplicate' and 'private' (discarded) messages. If
+        given, progress is called with the number of messages written
+        so far after each batch.
+        """
+        if not isinstance(qwk, DecodedPacket):
+            qwk = DecodedPacket(qwk)
+        bbsid = qwk.bbsid
+        stats = {}
+        cur = self.con.cursor()
+        try:
+            # Register the BBS and its forums if not previously known
+            cur.execute('INSERT OR IGNORE INTO board (id, title) VALUES (?, ?)',
+                        (bbsid, qwk.bbsname))
+            changed = cur.rowcount
+            cur.executemany('INSERT OR IGNORE INTO forum (id, boardid, title) '
+                            'VALUES (?, ?, ?)',
+                            [(forum, bbsid, qwk.forums[forum]) for forum in qwk.forums])
+            changed += cur.rowcount
+            for forum in qwk.forums:
+                stats[forum] = {'inserted': 0, 'duplicate': 0, 'private': 0}
+
+            # Queue up messages per forum and flush each queue when full
+            batches = {}
+            spans = {}
+            written = 0
+            for row in qwk.messages:
+                msgno, forum = row[0], row[1]
+                batch = batches.setdefault(forum, [])
+                span = spans.setdefault(forum, [msgno, msgno])
+                span[0] = min(span[0], msgno)
+                span[1] = max(span[1], msgno)
+                batch.append(row)
+                if len(batch) >= self.batchsize:
+                    self._insertBatch(cur, batch, stats[forum])
+                    written += len(batch)
+                    del batch[:]
+                    if progress:
+                        progress(written)
+            for forum, batch in batches.items():
+                if batch:
+                    self._insertBatch(cur, batch, stats[forum])
+                    written += len(batch)
+            if progress:
+                progress(written)
+            started = time.time()
+            for forum, (first, last) in spans.items():
+                self._linkForum(cur, bbsid, forum, first, last)
+            self.timings['link'] += time.time() - started
+            for forum in qwk.private:
+                stats[forum]['private'] = qwk.private[forum]
+
+            # Keep the cached forum message counts up to date
+            cur.executemany('UPDATE forum SET mcount = mcount + ? '
+                            'WHERE id = ? AND boardid = ?',
+                            [(stats[forum]['inserted'], forum, bbsid)
+                             for forum in stats if stats[forum]['inserted']])
+
+            # Expire cached pages of the board if anything was added
+            changed += sum([stats[forum]['inserted'] for forum in stats])
+            if changed:
+                cur.execute('UPDATE board SET generation = generation + 1, '
+                            'modified = ? WHERE id = ?', (int(time.time()), bbsid))
+        except:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        return stats
+
+    def _insertBatch(self, cur, batch, forumstats):
+        """
+        Inserts a batch of message rows from one forum, with their
+        authors and timestamps, updating the forum's inserted and
+        duplicate counts.
+        """
+        started = time.time()
+        cur.executemany('INSERT OR IGNORE INTO author (name) VALUES (?)',
+                        [(name,) for name in set([row[5] for row in batch] +
+                                                 [row[6] for row in batch])])
+        cur.executemany('INSERT OR IGNORE INTO message (id, forumid, boardid, '
+                        'mdate, mtime, mto, mfrom, reference, subject, body, '
+                        'posted, toid, fromid) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, qwkcompress(?), ?, '
+                        '(SELECT id FROM author WHERE name = ?), '
+                        '(SELECT id FROM author WHERE name = ?))',
+                        [row + (timestamp(row[3], row[4]), row[5], row[6])
+                         for row in batch])
+        forumstats['inserted'] += cur.rowcount
+        forumstats['duplicate'] += len(batch) - cur.rowcount
+        threaded = time.time()
+        self._threadBatch(cur, batch)
+        self.timings['insert'] += threaded - started
+        self.timings['thread'] += time.time() - threaded
+
+    def _threadBatch(self, cur, batch):
+        """
+        Adds thread rows for a batch of message rows from one forum. A
+        message whose parent is not in the archive starts a thread of
+        its own, and is adopted by the parent if it arrives later.
+        """
+        forum, bbsid = batch[0][1], batch[0][2]
+        # Look up the batch's messages and the messages they reply to
+        # in the thread table.
+        known = {}
+        ids = list(set([row[0] for row in batch] + [row[7] for row in batch if row[7]]))
+        for x in range(0, len(ids), self.batchsize):
+            chunk = ids[x:x+self.batchsize]
+            cur.execute('SELECT id, root, depth, path FROM thread '
+                        'WHERE boardid = ? AND forumid = ? AND id IN (%s)' %
+                        ', '.join(['?'] * len(chunk)), [bbsid, forum] + chunk)
+            for msgno, root, depth, path in cur.fetchall():
+                known[msgno] = (root, depth, path)
+
+        rows = []
+        for row in sorted(batch):
+            msgno, reference = row[0], row[7]
+            if msgno in known:
+                # Already in the archive
+                continue
+            if reference and reference != msgno and reference in known:
+                root, depth, path = known[reference]
+                parent, depth, path = reference, depth + 1, path + PATHSTEP % msgno
+            else:
+                parent, root, depth, path = None, msgno, 0, PATHSTEP % msgno
+            known[msgno] = (root, depth, path)
+            rows.append((msgno, forum, bbsid, reference, parent, root, depth, path))
+        cur.executemany('INSERT OR IGNORE INTO thread (id, forumid, boardid, '
+                        'reference, parent, root, depth, path) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+        # Adopt replies that arrived before these messages did, moving
+        # the threads they started under their parents.
+        orphans = []
+        ids = [row[0] for row in rows]
+        for x in range(0, len(ids), self.batchsize):
+            chunk = ids[x:x+self.batchsize]
+            cur.execute('SELECT id, reference FROM thread '
+                        'WHERE boardid = ? AND forumid = ? AND parent IS NULL '
+                        'AND reference IN (%s)' % ', '.join(['?'] * len(chunk)),
+                        [bbsid, forum] + chunk)
+            orphans.extend(cur.fetchall())
+        for msgno, parent in sorted(orphans):
+            if msgno == parent:
+                continue
+            cur.execute('SELECT root, depth, path FROM thread '
+                        'WHERE boardid = ? AND forumid = ? AND id = ?',
+                        (bbsid, forum, parent))
+            root, depth, path = cur.fetchone()
+            if root == msgno:
+                # The parent is itself a reply in this thread. Adopting
+                # would make a loop.
+                continue
+            cur.execute('UPDATE thread SET root = ?, depth = depth + ?, path = ? || path '
+                        'WHERE boardid = ? AND forumid = ? AND root = ?',
+                        (root, depth + 1, path, bbsid, forum, msgno))
+            cur.execute('UPDATE thread SET parent = ? '
+                        'WHERE boardid = ? AND forumid = ? AND id = ?',
+                        (parent, bbsid, forum, msgno))
+
+    def _linkForum(self, cur, bbsid, forum, first, last):
+        """
+        Updates the previous and next message links of the forum's
+        messages from first to last, and of their neighbours.
+        """
+        cur.execute('UPDATE thread SET '
+                    'prevno = (SELECT max(id) FROM thread AS t WHERE t.boardid = thread.boardid '
+                    'AND t.forumid = thread.forumid AND t.id < thread.id), '
+                    'nextno = (SELECT min(id) FROM thread AS t WHERE t.boardid = thread.boardid '
+                    'AND t.forumid = thread.forumid AND t.id > thread.id) '
+                    'WHERE boardid = ? AND forumid = ? '
+                    'AND id >= coalesce((SELECT max(id) FROM thread WHERE boardid = ? '
+                    'AND forumid = ? AND id < ?), ?) '
+                    'AND id <= coalesce((SELECT min(id) FROM thread WHERE boardid = ? '
+                    'AND forumid = ? AND id > ?), ?)',
+                    (bbsid, forum, bbsid, forum, first, first, bbsid, forum, last, last))
+
+
+def findPackets(paths):
+    """
+    Lists the packet files named by paths, searching directories for
+    .qwk files.
+    """
+    packets = []
+    for path in paths:
+        if not os.path.isdir(path):
+            packets.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith('.qwk'):
+                    packets.append(os.path.join(dirpath, name))
+    return packets
+
+def checksum(path):
+    """
+    Returns the SHA-1 of a file as hex.
+    """
+    digest = hashlib.sha1()
+    file = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: file.read(1024 * 1024), ''):
+            digest.update(chunk)
+    finally:
+        file.close()
+    return digest.hexdigest()
+
+# Checksums of the packets already in the database, in each decoding
+# process.
+_imported = set()
+
+def _initDecoder(imported):
+    global _imported
+    _imported = imported
+
+def decodeFile(path):
+    """
+    Decodes a packet file in a decoding process. Returns the path, the
+    checksum, the DecodedPacket, or None if the packet was imported
+    before, and an error message, or None if all went well.
+    """
+    try:
+        digest = checksum(path)
+        if digest in _imported:
+            return path, digest, None, None
+        return path, digest, DecodedPacket(QwkPacket(path, eager=False)).load(), None
+    except Exception, e:
+        return path, None, None, str(e)
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] database packet|directory...',
+        description='Imports QWK packets into a QwkWeb SQLite database. '
+                    'Directories are searched for .qwk files. Packets '
+                    'imported by an earlier run are skipped.')
+    parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count(),
+                      help='number of packets to decode at once '
+                           '(default: the number of CPUs)')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) < 2:
+        parser.error('a database and at least one packet are required')
+
+    con = qwkdb.connect(args[0])
+    # The queue workers' writer lock, taken for each packet so that they
+    # can carry on importing uploads in between
+    lock = open(args[0] + '.lock', 'ab')
+    imported = set([row[0] for row in con.execute('SELECT checksum FROM packet')])
+    packets = findPackets(args[1:])
+    importer = PacketImporter(con)
+    pool = multiprocessing.Pool(options.jobs, _initDecoder, (imported,))
+    # Decoded packets are held in memory until written, so only a few
+    # are handed to the pool at a time.
+    window = options.jobs * 4
+    counts = {'imported': 0, 'skipped': 0, 'failed': 0, 'messages': 0, 'inserted': 0}
+    started = time.time()
+    try:
+        for x in range(0, len(packets), window):
+            for path, digest, qwk, error in pool.imap_unordered(decodeFile,
+                                                                packets[x:x+window]):
+                if error is not None:
+                    print >> sys.stderr, "%s: %s" % (path, error)
+                    counts['failed'] += 1
+                    continue
+                if qwk is None or digest in imported:
+                    counts['skipped'] += 1
+                    continue
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # Log the packet in the transaction that
+                    # importPacket() commits or rolls back.
+                    con.execute('INSERT INTO packet (checksum, name, boardid, '
+                                'messages, imported) VALUES (?, ?, ?, ?, ?)',
+                                (digest, os.path.basename(path), qwk.bbsid,
+                                 len(qwk.messages), int(time.time())))
+                    stats = importer.importPacket(qwk)
+                except sqlite3.OperationalError:
+                    # The database is locked, full or the like; stop.
+                    raise
+                except Exception, e:
+                    # Only this packet is bad; carry on with the rest.
+                    print >> sys.stderr, "%s: %s" % (path, e)
+                    counts['failed'] += 1
+                    continue
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                imported.add(digest)
+                inserted = sum([stats[forum]['inserted'] for forum in stats])
+                counts['imported'] += 1
+                counts['messages'] += len(qwk.messages)
+                counts['inserted'] += inserted
+                print "%s: %d messages, %d new (%.0f messages/s)" % (
+                    path, len(qwk.messages), inserted,
+                    counts['messages'] / max(time.time() - started, 0.001))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        con.close()
+        lock.close()
+
+    elapsed = time.time() - started
+    print "%d packets imported, %d skipped, %d failed." % (
+        counts['imported'], counts['skipped'], counts['failed'])
+    print "%d messages, %d new, in %.1f seconds (%.0f messages/s)." % (
+        counts['messages'], counts['inserted'], elapsed,
+        counts['messages'] / max(elapsed, 0.001))
+    return counts['failed'] and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
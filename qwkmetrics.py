@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# QwkWeb metrics.
+
+"""
+Metrics collected by the web interface, served at /metrics in the
+Prometheus text format. Request latency is recorded per route, and the
+time taken by each SQL query per route and query. Import timings come
+from the queue workers, which run in other processes and keep their
+totals in the spool (see ImportQueue.addTimings).
+
+Metrics are held in memory by each server process, so a server running
+several processes reports on whichever one answers the scrape.
+"""
+
+import re
+import time
+import itertools
+import threading
+import web
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Content type of the Prometheus text format.
+CONTENTTYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    """
+    Escapes a label value.
+    """
+    return unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+def number(value):
+    """
+    Formats a sample value.
+    """
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+class Histogram:
+    """
+    Counts of observed values at or below each bucket's upper bound,
+    with their sum.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for x, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[x] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    """
+    Counters and histograms by name and label values. Metrics must be
+    declared before samples are recorded for them.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def declare(self, name, kind, help, labels=()):
+        """
+        Declares a metric of the given kind, 'counter', 'gauge' or
+        'histogram', with the names of its labels.
+        """
+        self.metrics[name] = (kind, help, tuple(labels), {})
+
+    def inc(self, name, labels=(), amount=1):
+        """
+        Adds to a counter.
+        """
+        samples = self.metrics[name][3]
+        with self.lock:
+            samples[tuple(labels)] = samples.get(tuple(labels), 0) + amount
+
+    def set(self, name, labels=(), value=0):
+        """
+        Sets a gauge, or a counter kept elsewhere.
+        """
+        with self.lock:
+            self.metrics[name][3][tuple(labels)] = value
+
+    def observe(self, name, labels, value):
+        """
+        Records a value in a histogram.
+        """
+        samples = self.metrics[name][3]
+        with self.lock:
+            histogram = samples.get(tuple(labels))
+            if histogram is None:
+                histogram = samples[tuple(labels)] = Histogram()
+            histogram.observe(value)
+
+    def text(self):
+        """
+        Returns all metrics in the Prometheus text format.
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(self.metrics):
+                kind, help, names, samples = self.metrics[name]
+                lines.append(u'# HELP %s %s' % (name, help))
+                lines.append(u'# TYPE %s %s' % (name, kind))
+                for values in sorted(samples):
+                    labels = [u'%s="%s"' % (label, escape(value))
+                              for label, value in zip(names, values)]
+                    if kind != 'histogram':
+                        lines.append(u'%s%s %s' % (name, labels and u'{%s}' % u','.join(labels)
+                                                   or u'', number(samples[values])))
+                        continue
+                    histogram = samples[values]
+                    for bound, count in zip(histogram.buckets + (float('inf'),),
+                                            histogram.counts + [histogram.count]):
+                        lines.append(u'%s_bucket{%s} %d' % (
+                            name, u','.join(labels + [u'le="%s"' % number(bound)]), count))
+                    lines.append(u'%s_sum{%s} %s' % (name, u','.join(labels),
+                                                     number(histogram.sum)))
+                    lines.append(u'%s_count{%s} %d' % (name, u','.join(labels),
+                                                       histogram.count))
+        return u'\n'.join(lines) + u'\n'
+
+
+registry = Registry()
+registry.declare('qwkweb_request_seconds', 'histogram',
+                 'Time taken to answer requests, including streaming the page.',
+                 ('route', 'status'))
+registry.declare('qwkweb_query_seconds', 'histogram',
+                 'Time taken by SQL queries to return their first row.',
+                 ('route', 'query'))
+registry.declare('qwkweb_slow_queries_total', 'counter',
+                 'SQL queries slower than the slowquery setting.', ('route',))
+registry.declare('qwkweb_import_packets_total', 'counter',
+                 'Packets imported by the queue workers.', ('state',))
+registry.declare('qwkweb_import_messages_total', 'counter',
+                 'Messages written by the queue workers.')
+registry.declare('qwkweb_import_seconds_total', 'counter',
+                 'Time spent by the queue workers in each phase of importing.',
+                 ('phase',))
+
+
+def route():
+    """
+    Returns the route of the request being answered, or '' outside of
+    requests.
+    """
+    return web.ctx.get('route', '')
+
+def requestTimer(urls):
+    """
+    Returns a web.py processor recording the latency of each request,
+    labelled with the name of the class handling its URL. Streamed pages
+    are timed until their last chunk has been sent.
+
+    web.py only handles errors raised while a handler is called, so
+    streamed pages are run up to their first chunk here. Errors before
+    then, such as bad parameters, get an error page instead of escaping
+    to the server.
+    """
+    routes = [(re.compile('^' + urls[x] + '$'), urls[x + 1]) for x in range(0, len(urls), 2)]
+
+    def record(name, started, status=None):
+        registry.observe('qwkweb_request_seconds',
+                         (name, (status or web.ctx.get('status', '200'))[:3]),
+                         time.time() - started)
+
+    def stream(chunks, name, started):
+        try:
+            for chunk in chunks:
+                yield chunk
+        except:
+            record(name, started, '500')
+            raise
+        record(name, started)
+
+    def processor(handle):
+        name = 'notfound'
+        for pattern, handler in routes:
+            if pattern.match(web.ctx.path):
+                name = handler
+                break
+        web.ctx.route = name
+        started = time.time()
+        try:
+            result = handle()
+            if hasattr(result, 'next'):
+                try:
+                    first = [result.next()]
+                except StopIteration:
+                    first = []
+        except web.HTTPError:
+            record(name, started)
+            raise
+        except:
+            record(name, started, '500')
+            raise
+        if hasattr(result, 'next'):
+            return stream(itertools.chain(first, result), name, started)
+        record(name, started)
+        return result
+    return processor
+
+def recordQuery(query, elapsed, slow):
+    """
+    Records the time taken by an SQL query in the current request.
+    """
+    registry.observe('qwkweb_query_seconds', (route(), ' '.join(query.split())), elapsed)
+    if slow:
+        registry.inc('qwkweb_slow_queries_total', (route(),))
+
+def recordImports(totals):
+    """
+    Loads the import totals kept by the queue workers.
+    """
+    for state, count in totals.get('packets', {}).items():
+        registry.set('qwkweb_import_packets_total', (state,), count)
+    registry.set('qwkweb_import_messages_total', (), totals.get('messages', 0))
+    for phase, seconds in totals.get('seconds', {}).items():
+        registry.set('qwkweb_import_seconds_total', (phase,), seconds)
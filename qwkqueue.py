@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# QwkWeb import queue.
+
+"""
+Queue of uploaded QWK packets waiting to be imported. The web interface
+saves uploads in a spool directory and returns straight away; a pool of
+worker processes, started by running this module, imports them in the
+background. Workers decode packets in parallel but take turns writing
+to the database, holding a lock file next to it while they import.
+
+Each job has two files in the spool: the packet, named after the job
+with an extension showing its state (.qwk while queued, .work while
+being imported and .failed if the import failed), and a .json file
+holding the job's status. While a job is imported its decoded messages
+are kept in a .rows file as well. The status of a finished job, and the
+packet if it failed, are kept for a week by default, then swept away. Workers also add up the time spent in
+each phase of their imports in metrics.json, for the web interface's
+metrics.
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import uuid
+import fcntl
+import shutil
+import multiprocessing
+from qwk import QwkPacket
+from qwkimport import DecodedPacket, PacketImporter
+import qwkdb
+
+# Seconds between looks at the spool when it is empty.
+POLLINTERVAL = 2
+
+# Seconds between sweeps of the spool for expired jobs.
+SWEEPINTERVAL = 3600
+
+# Days the status of a finished job is kept, unless configured.
+EXPIRE = 7
+
+# Job ids are the submission time and a random suffix, so that sorting
+# them lists jobs oldest first.
+jobpattern = re.compile(r'^[0-9]{14}-[0-9a-f]{12}$')
+
+
+class ImportQueue:
+    """
+    Spool directory of packets waiting to be imported.
+    """
+    def __init__(self, spool):
+        self.spool = spool
+        if not os.path.isdir(spool):
+            os.makedirs(spool)
+
+    def _path(self, job, extension):
+        """
+        Returns the name of one of a job's files in the spool.
+        """
+        return os.path.join(self.spool, job + extension)
+
+    def submit(self, packet):
+        """
+        Queues a packet, read from a file like object, for import.
+        Returns the id of the new job.
+        """
+        job = '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:12])
+        spooled = open(self._path(job, '.tmp'), 'wb')
+        try:
+            shutil.copyfileobj(packet, spooled)
+        finally:
+            spooled.close()
+        self.setStatus(job, {'state': 'queued', 'submitted': int(time.time())})
+        # Only now will workers see the job
+        os.rename(self._path(job, '.tmp'), self._path(job, '.qwk'))
+        return job
+
+    def status(self, job):
+        """
+        Returns the status of a job as a dict, or None if there is no
+        such job. The 'state' key is one of 'queued', 'decoding',
+        'waiting' (for the writer lock), 'importing', 'done' or
+        'failed'.
+        """
+        if not jobpattern.match(job):
+            return None
+        try:
+            file = open(self._path(job, '.json'), 'rb')
+        except IOError:
+            return None
+        try:
+            return json.load(file)
+        finally:
+            file.close()
+
+    def setStatus(self, job, status):
+        """
+        Replaces the status of a job. Readers see either the old or the
+        new status, never a partly written file.
+        """
+        file = open(self._path(job, '.json.tmp'), 'wb')
+        try:
+            json.dump(status, file)
+        finally:
+            file.close()
+        os.rename(self._path(job, '.json.tmp'), self._path(job, '.json'))
+
+    def totals(self):
+        """
+        Returns the import totals added up by addTimings().
+        """
+        try:
+            file = open(os.path.join(self.spool, 'metrics.json'), 'rb')
+        except IOError:
+            return {}
+        try:
+            return json.load(file)
+        finally:
+            file.close()
+
+    def addTimings(self, state, messages, timings):
+        """
+        Adds a finished job to the import totals: its final state, the
+        number of messages it wrote and the seconds spent in each phase.
+        """
+        lock = open(os.path.join(self.spool, 'metrics.lock'), 'ab')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = self.totals()
+            packets = totals.setdefault('packets', {})
+            packets[state] = packets.get(state, 0) + 1
+            totals['messages'] = totals.get('messages', 0) + messages
+            seconds = totals.setdefault('seconds', {})
+            for phase in timings:
+                seconds[phase] = seconds.get(phase, 0.0) + timings[phase]
+            file = open(os.path.join(self.spool, 'metrics.json.tmp'), 'wb')
+            try:
+                json.dump(totals, file)
+            finally:
+                file.close()
+            os.rename(os.path.join(self.spool, 'metrics.json.tmp'),
+                      os.path.join(self.spool, 'metrics.json'))
+        finally:
+            lock.close()
+
+    def claim(self):
+        """
+        Takes the oldest queued job for importing. Returns its id, or
+        None if no jobs are queued.
+        """
+        for name in sorted(os.listdir(self.spool)):
+            job, extension = os.path.splitext(name)
+            if extension != '.qwk':
+                continue
+            try:
+                os.rename(self._path(job, '.qwk'), self._path(job, '.work'))
+            except OSError:
+                # Claimed by another worker
+                continue
+            return job
+        return None
+
+    def requeue(self):
+        """
+        Puts jobs left behind by workers that were stopped part way
+        through an import back in the queue. Their transactions were
+        never committed, so they are imported again from the start.
+        """
+        for name in os.listdir(self.spool):
+            job, extension = os.path.splitext(name)
+            if extension == '.work':
+                status = self.status(job) or {}
+                status['state'] = 'queued'
+                self.setStatus(job, status)
+                os.rename(self._path(job, '.work'), self._path(job, '.qwk'))
+
+    def expire(self, age):
+        """
+        Removes the status of jobs that finished more than age seconds
+        ago, with the packets of those that failed.
+        """
+        cutoff = time.time() - age
+        for name in os.listdir(self.spool):
+            job, extension = os.path.splitext(name)
+            if extension != '.json' or not jobpattern.match(job):
+                continue
+            status = self.status(job) or {}
+            if status.get('state') not in ('done', 'failed') or \
+                    status.get('finished', cutoff) >= cutoff:
+                continue
+            for extension in ('.failed', '.json'):
+                try:
+                    os.remove(self._path(job, extension))
+                except OSError:
+                    # Removed by another worker, or the job succeeded
+                    pass
+
+    def run(self, job, database, config=None):
+        """
+        Imports a claimed job into the SQLite database with the given
+        file name, recording its progress in its status. The seconds
+        spent in each phase of the import are kept in the status as
+        timings.
+        """
+        status = self.status(job) or {}
+        def update(**changes):
+            status.update(changes)
+            self.setStatus(job, status)
+
+        timings = {}
+        def phase(name, started):
+            timings[name] = time.time() - started
+            return time.time()
+
+        try:
+            update(state='decoding', started=int(time.time()))
+            started = time.time()
+            packet = QwkPacket(self._path(job, '.work'), eager=False)
+            header = time.time() - started
+            # Decoded rows are spooled to disk rather than kept in
+            # memory while waiting for the writer lock
+            qwk = DecodedPacket(packet).spool(self._path(job, '.rows'))
+            timings.update(qwk.timings)
+            timings['parse'] += header
+            # The rest is writing the rows to the spool
+            timings['spool'] = time.time() - started - timings['parse'] - timings['decode']
+            started = time.time()
+            update(state='waiting', bbsid=qwk.bbsid, bbsname=qwk.bbsname,
+                   messages=qwk.count, written=0)
+            # One writer per database at a time. The lock is released
+            # when the lock file is closed.
+            lock = open(database + '.lock', 'ab')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                started = phase('wait', started)
+                update(state='importing')
+                con = qwkdb.connect(database, config)
+                importer = PacketImporter(con)
+                try:
+                    stats = importer.importPacket(
+                        qwk, lambda written: update(written=written))
+                finally:
+                    con.close()
+                timings.update(importer.timings)
+                # The rest of the import: reading the spooled rows back
+                # and committing
+                timings['commit'] = time.time() - started - sum(importer.timings.values())
+            finally:
+                lock.close()
+        except Exception, e:
+            update(state='failed', finished=int(time.time()), error=str(e),
+                   timings=timings)
+            os.rename(self._path(job, '.work'), self._path(job, '.failed'))
+            self.addTimings('failed', 0, timings)
+            return
+        finally:
+            if os.path.exists(self._path(job, '.rows')):
+                os.remove(self._path(job, '.rows'))
+        update(state='done', finished=int(time.time()), timings=timings,
+               forums=[dict(stats[forum], forum=forum, title=qwk.forums[forum])
+                       for forum in sorted(stats)])
+        os.remove(self._path(job, '.work'))
+        self.addTimings('done', sum([stats[forum]['inserted'] for forum in stats]), timings)
+
+
+def worker(spool, database, expire):
+    """
+    Imports queued jobs one after the other, forever. While there are
+    none, jobs finished more than expire days ago are swept from the
+    spool now and then.
+    """
+    queue = ImportQueue(spool)
+    config = qwkdb.readConfig()
+    swept = 0
+    while True:
+        job = queue.claim()
+        if job is None:
+            if time.time() - swept > SWEEPINTERVAL:
+                queue.expire(expire * 86400)
+                swept = time.time()
+            time.sleep(POLLINTERVAL)
+            continue
+        queue.run(job, database, config)
+
+
+if __name__ == '__main__':
+    config = qwkdb.readConfig()
+    if config.get('qwkweb', 'dbn') != 'sqlite':
+        sys.exit('The import queue only supports SQLite databases.')
+    database = config.get('qwkweb', 'db')
+    spool = 'spool'
+    if config.has_option('queue', 'spool'):
+        spool = config.get('queue', 'spool')
+    workers = multiprocessing.cpu_count()
+    if config.has_option('queue', 'workers'):
+        workers = config.getint('queue', 'workers')
+    expire = EXPIRE
+    if config.has_option('queue', 'expire'):
+        expire = config.getfloat('queue', 'expire')
+
+    ImportQueue(spool).requeue()
+    processes = [multiprocessing.Process(target=worker, args=(spool, database, expire))
+                 for x in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
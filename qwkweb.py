@@ -1,30 +1,73 @@
 #!/usr/bin/env python
 
 import os.path
-from base64 import b64decode
-import ConfigParser
-from StringIO import StringIO
+import re
+import time
+import calendar
+from base64 import b64decode, urlsafe_b64encode, urlsafe_b64decode
+import json
+import urllib
+import tempfile
+from datetime import datetime
 import web
-from qwk import QwkMessage, QwkPacket
+from qwk import QwkMessage, QwkWriter
+from qwkcache import ResponseCache
+from qwkqueue import ImportQueue
+import qwkdb
+import qwkmetrics
 
-render = web.template.render('templates/')
+render = web.template.render('templates/', cache=True,
+                             globals={'urlquote': web.urlquote})
+# Compile all templates now rather than on first use.
+for name in os.listdir('templates'):
+    if name.endswith('.html'):
+        getattr(render, name[:-5])
 
-config = ConfigParser.ConfigParser()
-config.read(['.qwkweb.conf', os.path.expanduser('~/.qwkweb.conf'),
-             '/etc/qwkweb.conf'])
+# Largest number of rows on one page of a listing.
+MAXSIZE = 1000
+# Rows rendered at a time when streaming a listing.
+ROWCHUNK = 50
+# Columns of the message table shown in listings.
+ROWCOLUMNS = 'id, boardid, forumid, mdate, mtime, mfrom, mto, subject'
+# Columns of the message table, with the body decompressed.
+MESSAGECOLUMNS = ('message.id, message.forumid, message.boardid, message.mdate, '
+                  'message.mtime, message.mto, message.mfrom, message.reference, '
+                  'message.subject, qwkbody(message.body) AS body')
 
-db_parameters = {}
-for key, value in config.items('qwkweb'):
-    db_parameters[key] = value
-db = web.database(**db_parameters)
+config = qwkdb.readConfig()
+# Debugging shows tracebacks on error pages and prints every query, so
+# it is off unless configured.
+web.config.debug = config.has_option('server', 'debug') and \
+    config.getboolean('server', 'debug')
+db = qwkdb.database(config)
+
+# Rendered pages are cached in memory, up to the configured size in
+# megabytes.
+if config.has_option('cache', 'size'):
+    cache = ResponseCache(config.getint('cache', 'size') * 1024 * 1024)
+else:
+    cache = ResponseCache(32 * 1024 * 1024)
+
+# Uploaded packets are spooled here and imported in the background by
+# the workers started by qwkqueue.py.
+if config.has_option('queue', 'spool'):
+    queue = ImportQueue(config.get('queue', 'spool'))
+else:
+    queue = ImportQueue('spool')
 
 urls = (
     '/', 'Index',
     '/search', 'Search',
     '/upload', 'Upload',
-    '/(.*)/(.*)/(.*)/?', 'ViewMessage',
-    '/(.*)/(.*)/?', 'ForumIndex',
-    '/(.*)/?', 'BoardIndex',
+    '/upload/(.*)', 'UploadStatus',
+    '/metrics', 'Metrics',
+    '/dates', 'DateIndex',
+    '/author/(.*)', 'AuthorIndex',
+    '/([^/]+)/(\d+)/export.qwk', 'ExportPacket',
+    '/([^/]+)/(\d+)/thread/(\d+)/?', 'ViewThread',
+    '/([^/]+)/(\d+)/(\d+)/?', 'ViewMessage',
+    '/([^/]+)/(\d+)/?', 'ForumIndex',
+    '/([^/]+)/?', 'BoardIndex',
     )
 
 
@@ -52,19 +95,278 @@ def auth():
             return True
     return False
 
-def sqlquote(value):
+def internalerror():
+    """
+    Error page for unexpected errors. web.py has logged the traceback,
+    so only say that something went wrong, unless debugging.
+    """
+    if web.config.debug:
+        return web.debugerror()
+    return web.internalerror("Internal server error. The error has been logged.")
+
+def ftsquery(column, text):
+    """
+    Turns search text for one column into an FTS5 query. All words must
+    match; "quoted words" match as a phrase and a trailing * matches
+    any word with that prefix.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+        prefix = word.endswith('*')
+        term = (phrase or word.rstrip('*')).strip()
+        if term:
+            terms.append('"%s"%s' % (term.replace('"', '""'), prefix and ' *' or ''))
+    if terms:
+        return '%s : (%s)' % (column, ' AND '.join(terms))
+
+def highlight(snippet):
+    """
+    Escapes a search result snippet for HTML, turning the markers placed
+    around matching words into highlights.
+    """
+    return web.websafe(snippet).replace(u'\x02', u'<b>').replace(u'\x03', u'</b>')
+
+def pagesize(value):
+    """
+    Reads the number of rows per page from the size parameter, kept
+    between 1 and MAXSIZE.
+    """
+    try:
+        return min(max(int(value), 1), MAXSIZE)
+    except ValueError:
+        raise web.badrequest()
+
+def paginate(tables, vars, where, what, columns, size):
+    """
+    Selects one page of rows, ordered on the given key columns. Pages
+    are found by seeking past the key of the last row seen, taken from
+    the after or before cursor in the query string, so deep pages cost
+    no more than the first. Returns a Page.
+    """
+    form = web.input(after='', before='')
+    vars = dict(vars)
+    where = where and [where] or []
+    backward = bool(form.before)
+    cursor = None
+    if form.before or form.after:
+        try:
+            cursor = json.loads(urlsafe_b64decode(str(form.before or form.after)))
+        except (TypeError, ValueError):
+            raise web.badrequest()
+        if not isinstance(cursor, list) or len(cursor) != len(columns):
+            raise web.badrequest()
+        for x, value in enumerate(cursor):
+            vars['k%d' % x] = value
+        where.append('(%s) %s (%s)' % (', '.join(columns), backward and '<' or '>',
+                     ', '.join(['$k%d' % x for x in range(len(columns))])))
+    # The limit is bound rather than written into the query, so that the
+    # page size does not make a new query in the metrics
+    vars['limit'] = size + 1
+    query = 'SELECT %s%s FROM %s%s ORDER BY %s LIMIT $limit' % (
+        what, ''.join([', %s AS k%d' % (column, x) for x, column in enumerate(columns)]),
+        tables, where and ' WHERE ' + ' AND '.join(where) or '',
+        ', '.join([column + (backward and ' DESC' or '') for column in columns]))
+    if backward:
+        # Put the rows before the cursor, found nearest first, back in
+        # order. total tells whether the first is an extra row fetched
+        # to see if there is a page before this one.
+        query = 'SELECT *, count(*) OVER () AS total FROM (%s) ORDER BY %s' % (
+            query, ', '.join(['k%d' % x for x in range(len(columns))]))
+    return Page(db.query(query, vars=vars), size, len(columns), cursor is not None, backward)
+
+class Page:
+    """
+    One page of rows selected by paginate(). Rows are fetched from the
+    database as the page is iterated over, so a page is never held in
+    memory. Once it has been, count is the number of rows, and
+    prevcursor and nextcursor are the cursors of the previous and next
+    pages, or None if there is no such page.
+    """
+    def __init__(self, rows, size, keys, cursor, backward):
+        self.rows = rows
+        self.size = size
+        self.keys = keys
+        self.cursor = cursor
+        self.backward = backward
+        self.count = 0
+        self.prevcursor = self.nextcursor = None
+
+    def _rowcursor(self, row):
+        return urlsafe_b64encode(json.dumps([row['k%d' % x] for x in range(self.keys)]))
+
+    def __iter__(self):
+        first = last = None
+        more = False
+        for row in self.rows:
+            if self.backward and first is None and not more and row.total > self.size:
+                more = True
+                continue
+            if not self.backward and self.count == self.size:
+                more = True
+                break
+            if first is None:
+                first = row
+            last = row
+            self.count += 1
+            yield row
+        if first is None:
+            return
+        if self.backward:
+            # The extra row was before the page, and the cursor came
+            # from the page after it
+            if more:
+                self.prevcursor = self._rowcursor(first)
+            if self.cursor:
+                self.nextcursor = self._rowcursor(last)
+        else:
+            if self.cursor:
+                self.prevcursor = self._rowcursor(first)
+            if more:
+                self.nextcursor = self._rowcursor(last)
+
+def chunked(rows):
+    """
+    Yields lists of up to ROWCHUNK rows at a time.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == ROWCHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def authorized(method):
+    """
+    Decorator for GET methods of pages that require a login.
+    """
+    def GET(self, *args):
+        if not auth():
+            unauthorized()
+            web.header('Content-Type', 'text/html; charset=utf-8')
+            return render.unauthorized()
+        return method(self, *args)
+    return GET
+
+def cached(method):
+    """
+    Decorator for GET methods of pages that only change when a packet
+    is imported into the board named by their first argument, or into
+    any board if they take no arguments. Pages are served from the
+    response cache while the board's generation is unchanged, and
+    carry ETag and Last-Modified headers for conditional requests.
+    Error responses have those headers taken off again, so that they
+    are never revalidated.
+    """
+    def GET(self, *args):
+        if args:
+            boards = list(db.select('board', {'board': args[0]},
+                                    what='id, generation, modified',
+                                    where='id = $board'))
+            if not boards:
+                return method(self, *args)
+            generation = '%s-%d' % (boards[0].id, boards[0].generation)
+            modified = boards[0].modified
+        else:
+            boards = db.select('board', what='count(*) AS count, '
+                               'total(generation) AS generation, '
+                               'max(modified) AS modified')[0]
+            generation = '%d-%d' % (boards.count, boards.generation)
+            modified = boards.modified
+        if modified:
+            modified = datetime.utcfromtimestamp(modified)
+        if not web.modified(modified or None, generation):
+            return ''
+        key = web.ctx.fullpath
+        page = cache.get(key, generation)
+        if page is not None:
+            web.header('Content-Type', 'text/html; charset=utf-8')
+            return page
+        try:
+            page = method(self, *args)
+        except:
+            dropvalidators()
+            raise
+        if hasattr(page, 'next'):
+            return cachestream(key, generation, page)
+        page = unicode(page)
+        cache.put(key, generation, page)
+        return page
+    return GET
+
+def dropvalidators():
+    """
+    Takes the ETag and Last-Modified headers set by cached() off the
+    response.
+    """
+    web.ctx.headers = [(name, value) for name, value in web.ctx.headers
+                       if name not in ('ETag', 'Last-Modified')]
+
+def cachestream(key, generation, chunks):
+    """
+    Passes on a page streamed in chunks, caching it once complete
+    unless it is too large for the cache.
+    """
+    page = []
+    size = 0
+    try:
+        for chunk in chunks:
+            chunk = unicode(chunk)
+            if page is not None:
+                page.append(chunk)
+                size += len(chunk)
+                if size > cache.maxsize:
+                    page = None
+            yield chunk
+    except:
+        # Streamed pages mostly fail on their first chunk, before the
+        # headers are sent
+        dropvalidators()
+        raise
+    if page is not None:
+        cache.put(key, generation, u''.join(page))
+
+def qwkencode(text):
+    """
+    Encodes text in the QWK character set.
+    """
+    return text.encode(QwkMessage.encoding, 'replace')
+
+def qwkmessage(row):
     """
-    web.sqlquote does strange things, so we make our own version.
+    Makes a QwkMessage out of a message table row.
     """
-    if isinstance(value, basestring):
-        return "'%s'" % value.replace("'", "''")
-    elif isinstance(value, (int, long, float)):
-        return value
+    return QwkMessage(' ', row.id, qwkencode(row.mdate), qwkencode(row.mtime),
+                      qwkencode(row.mto), qwkencode(row.mfrom), qwkencode(row.subject),
+                      '', row.reference, row.forumid, body=qwkencode(row.body))
+
+def filechunks(file, size=64 * 1024):
+    """
+    Yields the contents of a file in chunks, and closes it.
+    """
+    try:
+        file.seek(0)
+        for chunk in iter(lambda: file.read(size), ''):
+            yield chunk
+    finally:
+        file.close()
+
+def joined(row, prefix):
+    """
+    Picks the columns of a joined table, named with the given prefix, out
+    of a row. Returns None if the join found no match.
+    """
+    if row[prefix + 'id'] is None:
+        return None
+    return web.Storage([(key[len(prefix):], value) for key, value in row.items()
+                        if key.startswith(prefix)])
 
 class Index:
     """
     QwkWeb index page.
     """
+    @cached
     def GET(self):
         bbsnames = db.select('board', order='id')
         web.header('Content-Type', 'text/html; charset=utf-8')
@@ -74,17 +376,19 @@ class Search:
     """
     Search for a message.
     """
-    def GET(self):
-        if not auth():
-            unauthorized()
-            web.header('Content-Type', 'text/html; charset=utf-8')
-            return render.unauthorized()
+    # Sort orders accepted in the order parameter, with their key columns.
+    orders = {'rank': ['rank', 'message.rowid'],
+              'id': ['message.id', 'message.rowid'],
+              'mdate': ['message.posted', 'message.rowid'],
+              'mfrom': ['message.mfrom', 'message.rowid'],
+              'mto': ['message.mto', 'message.rowid'],
+              'subject': ['message.subject', 'message.rowid']}
 
-        form = web.input(start=0, size=100, order='id',
+    @authorized
+    def GET(self):
+        form = web.input(size=100, order='',
                          board='', mfrom='', mto='', subject='', body='')
-        start = int(form.start)
-        size = int(form.size)
-        order = form.order
+        size = pagesize(form.size)
 
         board = form.board
         mfrom = form.mfrom.strip()
@@ -92,108 +396,114 @@ class Search:
         subject = form.subject.strip()
         body = form.body.strip()
 
-        query = []
-        if board:
-            query.append("boardid = %s" % sqlquote(board))
-        if mfrom:
-            query.append("mfrom LIKE %s" % sqlquote('%'+mfrom+'%'))
-        if mto:
-            query.append("mto LIKE %s" % sqlquote('%'+mto+'%'))
-        if subject:
-            query.append("subject LIKE %s" % sqlquote('%'+subject+'%'))
-        if body:
-            query.append("body LIKE %s" % sqlquote('%'+body+'%'))
-        squery = ' AND '.join(query)
-
-        mcount = db.select('message',
-                            where=squery,
-                            what='count(*) as count')[0].count
-
-        messages = db.select('message', locals(),
-                              where=squery,
-                              what='id, boardid, forumid, mdate, mtime, mfrom, mto, subject',
-                              offset='$start',
-                              limit='$size',
-                              order='$order')
-        if start == 0:
-            prevstart = None
+        match = ' AND '.join(filter(None, [ftsquery('mfrom', mfrom),
+                                           ftsquery('mto', mto),
+                                           ftsquery('subject', subject),
+                                           ftsquery('body', body)]))
+        order = form.order
+        if match:
+            if order not in self.orders:
+                order = 'rank'
+            tables = 'message_fts JOIN message ON message.rowid = message_fts.rowid'
+            query = ['message_fts MATCH $match']
+            what = "snippet(message_fts, -1, $start_mark, $end_mark, '...', 16) AS snippet"
         else:
-            prevstart = max(0, start-size)
-        if start+size < mcount:
-            nextstart = start+size
+            if order not in self.orders or order == 'rank':
+                order = 'id'
+            tables = 'message'
+            query = []
+            what = "'' AS snippet"
+        if board:
+            query.append('message.boardid = $board')
+        squery = ' AND '.join(query) or None
+        start_mark, end_mark = u'\x02', u'\x03'
+
+        if match:
+            mcount = db.select(tables, locals(),
+                                where=squery,
+                                what='count(*) as count')[0].count
         else:
-            nextstart = None
+            # Without search terms, add up the cached forum counts.
+            mcount = db.select('forum', locals(),
+                                where=board and 'boardid = $board' or None,
+                                what='coalesce(sum(mcount), 0) as count')[0].count
 
+        page = paginate(tables, locals(), squery,
+            'message.id, message.boardid, message.forumid, message.mdate, '
+            'message.mtime, message.mfrom, message.mto, message.subject, ' + what,
+            self.orders[order], size)
+        link = urllib.urlencode([(key, value.encode('utf-8')) for key, value in
+                                 [('board', board), ('mfrom', mfrom), ('mto', mto),
+                                  ('subject', subject), ('body', body)]])
+
+        # Send the page in chunks as the rows are fetched
         web.header('Content-Type', 'text/html; charset=utf-8')
-        return render.search(mcount, list(messages),
-                            board, mfrom, mto, subject, body,
-                            order, size, prevstart=prevstart, nextstart=nextstart)
+        yield render.search(mcount, link)
+        if not mcount:
+            return
+        for rows in chunked(page):
+            for row in rows:
+                row.snippet = highlight(row.snippet)
+            yield render.messagerows(rows)
+        yield render.listfoot(page.count, '/search?%s&order=%s&size=%d' % (link, order, size),
+                              page.prevcursor, page.nextcursor)
 
 class Upload:
     """
     Handle an uploaded QWK packet.
     """
     def POST(self):
-        form = web.input()
-        qwkfile = form.qwkfile
-        yield "Parsing packet..."
-        qwk = QwkPacket(StringIO(qwkfile))
-
-        # Register the BBS if not previously known
-        bbsid = unicode(qwk.bbsid.lower(), 'cp850')
-        yield "BBS: %s: %s" % (bbsid, qwk.bbsname)
-        if db.select('board', locals(), what='count(*) as count',
-                      where='id = $bbsid')[0].count == 0:
-            db.insert('board', id=bbsid, title=unicode(qwk.bbsname, 'cp850'))
-
-        # Parse messages per forum
-        for forum in qwk.forums:
-            forumtitle = unicode(qwk.forums[forum]['title'], 'cp850')
-            if db.select('forum', locals(), what='count(*) as count',
-                          where='id = $forum AND boardid = $bbsid')[0].count == 0:
-                yield "Registering new forum: %d: %s" % (forum, forumtitle)
-                db.insert('forum', id=forum, boardid=bbsid, title=forumtitle)
-            for message in qwk.forums[forum]['messages']:
-                msgno = message.number
-                if message.private:
-                    yield "Discarded private message %d." % msgno
-                    continue
-                if db.select('message', locals(), what='count(*) as count',
-                              where='id = $msgno AND forumid = $forum AND boardid = $bbsid'
-                              )[0].count == 0:
-                    # Message not in archive already. Insert it.
-                    yield "Message %d in forum %d %s (%s %s/%s/%s/%s)." % (
-                        msgno, forum, forumtitle,
-                        unicode(message.date, 'cp850'),
-                        unicode(message.time, 'cp850'),
-                        unicode(message.mfrom, 'cp850'),
-                        unicode(message.mto, 'cp850'),
-                        unicode(message.subject, 'cp850'))
-                    db.insert('message',
-                               id = msgno,
-                               forumid = forum,
-                               boardid = bbsid,
-                               mdate = unicode(message.date, 'cp850'),
-                               mtime = unicode(message.time, 'cp850'),
-                               mfrom = unicode(message.mfrom, 'cp850'),
-                               mto = unicode(message.mto, 'cp850'),
-                               reference = message.reference,
-                               subject = unicode(message.subject, 'cp850'),
-                               body = unicode(message.body, 'cp850')
-                               )
-                else:
-                    yield "Ignoring duplicate message %d in forum %d %s." % (msgno, forum, forumtitle)
-        yield "Done."
+        form = web.input(qwkfile={})
+        if not hasattr(form.qwkfile, 'file'):
+            raise web.badrequest()
+        # Importing a large packet takes minutes, so leave it to the
+        # import workers and point at the job's status instead.
+        job = queue.submit(form.qwkfile.file)
+        web.ctx.status = '202 Accepted'
+        web.header('Location', '%s/upload/%s' % (web.ctx.home, job))
+        web.header('Content-Type', 'text/plain; charset=utf-8')
+        return "Packet queued for import as job %s.\nProgress: %s/upload/%s\n" % (
+            job, web.ctx.home, job)
+
+class UploadStatus:
+    """
+    Report the progress of an uploaded packet's import.
+    """
+    def GET(self, job):
+        status = queue.status(job)
+        if status is None:
+            raise web.notfound()
+        web.header('Content-Type', 'text/plain; charset=utf-8')
+        lines = ["Job %s: %s" % (job, status['state'])]
+        if 'bbsid' in status:
+            lines.append("BBS: %s: %s" % (status['bbsid'], status['bbsname']))
+        if status['state'] in ('waiting', 'importing'):
+            lines.append("%d of %d messages written." % (status['written'],
+                                                        status['messages']))
+        elif status['state'] == 'failed':
+            lines.append("Error: %s" % status['error'])
+        for forum in status.get('forums', []):
+            lines.append("Forum %d %s: %d new, %d duplicate, %d private messages discarded." % (
+                forum['forum'], forum['title'], forum['inserted'],
+                forum['duplicate'], forum['private']))
+        return u'\n'.join(lines) + u'\n'
+
+class Metrics:
+    """
+    Metrics for Prometheus to scrape.
+    """
+    def GET(self):
+        qwkmetrics.recordImports(queue.totals())
+        web.header('Content-Type', qwkmetrics.CONTENTTYPE)
+        return qwkmetrics.registry.text()
 
 class BoardIndex:
     """
     List available forums in a given BBS.
     """
+    @authorized
+    @cached
     def GET(self, board):
-        if not auth():
-            unauthorized()
-            web.header('Content-Type', 'text/html; charset=utf-8')
-            return render.unauthorized()
         boardnames = db.select('board', locals(), where='id = $board')
         #if not boardnames:
         #    return "Unknown board."
@@ -209,115 +519,245 @@ class ForumIndex:
     """
     List all messages in a given forum. Paginate.
     """
-    def GET(self, board, forum):
-        if not auth():
-            unauthorized()
-            web.header('Content-Type', 'text/html; charset=utf-8')
-            return render.unauthorized()
+    # Sort orders accepted in the order parameter, with their key columns.
+    orders = {'id': ['id'],
+              'mdate': ['posted', 'id'],
+              'mfrom': ['mfrom', 'id'],
+              'mto': ['mto', 'id'],
+              'subject': ['subject', 'id']}
 
-        form = web.input(start=0, size=100, order='id')
-        start = int(form.start)
-        size = int(form.size)
+    @authorized
+    @cached
+    def GET(self, board, forum):
+        form = web.input(size=100, order='id')
+        size = pagesize(form.size)
         order = form.order
+        if order not in self.orders:
+            order = 'id'
         forum = int(forum)
         boardnames = list(db.select('board', locals(), where='id = $board'))
         if not boardnames:
-            return "Unknown board."
+            yield "Unknown board."
+            return
         boardname = boardnames[0].title
         forumnames = list(db.select('forum', locals(), where='id = $forum AND boardid = $board'))
         if not forumnames:
-            return "Unknown forum."
+            yield "Unknown forum."
+            return
         forumname = forumnames[0].title
+        mcount = forumnames[0].mcount
 
-        # TODO: No pagination yet. Surely there is an elegant way to do this?
-        mcount = db.select('message', locals(),
-                            where='boardid = $board AND forumid = $forum',
-                            what='count(*) as count')[0].count
-        messages = db.select('message', locals(),
-                              where='boardid = $board AND forumid = $forum',
-                              what='id, mdate, mtime, mfrom, mto, subject',
-                              offset='$start',
-                              limit='$size',
-                              order=order)
-        if start == 0:
-            prevstart = None
-        else:
-            prevstart = max(0, start-size)
-        if start+size < mcount:
-            nextstart = start+size
+        page = paginate('message', locals(),
+            'boardid = $board AND forumid = $forum',
+            ROWCOLUMNS, self.orders[order], size)
+
+        # Send the page in chunks as the rows are fetched
+        web.header('Content-Type', 'text/html; charset=utf-8')
+        yield render.messagelist(board, boardname, forum, forumname, mcount)
+        for rows in chunked(page):
+            yield render.messagerows(rows)
+        yield render.listfoot(page.count, '/%s/%d?order=%s&size=%d' % (board, forum, order, size),
+                              page.prevcursor, page.nextcursor)
+
+class DateIndex:
+    """
+    List the messages posted between two dates, given as YYYY-MM-DD in
+    the from and to parameters, in date order. Paginate.
+    """
+    @authorized
+    @cached
+    def GET(self):
+        form = web.input(size=100, **{'from': '', 'to': ''})
+        size = pagesize(form.size)
+        # Messages with no valid date have a timestamp of 0, and are
+        # left out.
+        start = 1
+        end = 2 ** 62
+        try:
+            if form['from']:
+                start = calendar.timegm(time.strptime(form['from'], '%Y-%m-%d'))
+            if form['to']:
+                end = calendar.timegm(time.strptime(form['to'], '%Y-%m-%d')) + 86400
+        except ValueError:
+            raise web.badrequest()
+        mcount = db.select('message', locals(), what='count(*) AS count',
+                           where='posted >= $start AND posted < $end')[0].count
+        page = paginate('message', locals(), 'posted >= $start AND posted < $end',
+                        ROWCOLUMNS, ['posted', 'rowid'], size)
+
+        if form['from'] and form['to']:
+            title = 'Messages from %s to %s' % (form['from'], form['to'])
+        elif form['from']:
+            title = 'Messages since %s' % form['from']
+        elif form['to']:
+            title = 'Messages until %s' % form['to']
         else:
-            nextstart = None
+            title = 'All messages'
+        link = urllib.urlencode([('from', form['from']), ('to', form['to'])])
+        web.header('Content-Type', 'text/html; charset=utf-8')
+        yield render.browse(title, mcount)
+        for rows in chunked(page):
+            yield render.messagerows(rows)
+        yield render.listfoot(page.count, '/dates?%s&size=%d' % (link, size),
+                              page.prevcursor, page.nextcursor)
+
+class AuthorIndex:
+    """
+    List the messages from an author, or to them if the role parameter
+    is 'to', in date order. Paginate.
+    """
+    @authorized
+    def GET(self, name):
+        form = web.input(size=100, role='from')
+        size = pagesize(form.size)
+        role = form.role == 'to' and 'to' or 'from'
+        name = web.safeunicode(name)
+        authors = list(db.select('author', locals(), where='name = $name'))
+        if not authors:
+            yield "Unknown author."
+            return
+        author = authors[0].id
+        where = '%sid = $author' % role
+        mcount = db.select('message', locals(), what='count(*) AS count',
+                           where=where)[0].count
+        page = paginate('message', locals(), where, ROWCOLUMNS, ['posted', 'rowid'], size)
 
         web.header('Content-Type', 'text/html; charset=utf-8')
-        return render.messagelist(board, boardname, forum, forumname, list(messages),
-                                 order, size, prevstart=prevstart, nextstart=nextstart)
+        yield render.browse('Messages %s %s' % (role, authors[0].name.title()), mcount)
+        for rows in chunked(page):
+            yield render.messagerows(rows)
+        yield render.listfoot(page.count, '/author/%s?role=%s&size=%d' % (
+                              web.urlquote(authors[0].name), role, size),
+                              page.prevcursor, page.nextcursor)
 
 class ViewMessage:
     """
     View a message from a given board and forum.
     """
+    @authorized
+    @cached
     def GET(self, board, forum, msgno):
-        if not auth():
-            unauthorized()
-            web.header('Content-Type', 'text/html; charset=utf-8')
-            return render.unauthorized()
         forum = int(forum)
         msgno = int(msgno)
-        boardnames = db.select('board', locals(), where='id = $board')
-        #if not boardnames:
-        #    return "Unknown board."
+        # Load the message with its board, forum, reference and
+        # neighbours in one query.
+        messages = list(db.query("""
+            SELECT %s, board.title AS boardname, forum.title AS forumname,
+                thread.root AS root,
+                ref.id AS ref_id, ref.mfrom AS ref_mfrom, ref.mto AS ref_mto,
+                prev.id AS prev_id, prev.mfrom AS prev_mfrom,
+                prev.mto AS prev_mto, prev.subject AS prev_subject,
+                next.id AS next_id, next.mfrom AS next_mfrom,
+                next.mto AS next_mto, next.subject AS next_subject
+            FROM message
+            JOIN board ON board.id = message.boardid
+            JOIN forum ON forum.boardid = message.boardid AND forum.id = message.forumid
+            LEFT JOIN thread ON thread.boardid = message.boardid
+                AND thread.forumid = message.forumid AND thread.id = message.id
+            LEFT JOIN message AS ref ON ref.boardid = message.boardid
+                AND ref.forumid = message.forumid AND ref.id = message.reference
+            LEFT JOIN message AS prev ON prev.boardid = message.boardid
+                AND prev.forumid = message.forumid AND prev.id = thread.prevno
+            LEFT JOIN message AS next ON next.boardid = message.boardid
+                AND next.forumid = message.forumid AND next.id = thread.nextno
+            WHERE message.id = $msgno AND message.forumid = $forum
+                AND message.boardid = $board""" % MESSAGECOLUMNS, vars=locals()))
+        if len(messages) != 1:
+            if not list(db.select('board', locals(), where='id = $board')):
+                return "Unknown board."
+            if not list(db.select('forum', locals(), where='id = $forum AND boardid = $board')):
+                return "Unknown forum."
+            return "No such message."
+        message = messages[0]
+        reference = joined(message, 'ref_')
+        prevmsg = joined(message, 'prev_')
+        nextmsg = joined(message, 'next_')
+        followups = list(db.select('thread JOIN message ON message.boardid = thread.boardid '
+                                   'AND message.forumid = thread.forumid AND message.id = thread.id',
+                                   locals(),
+                                   what='message.id, message.mfrom',
+                                   where='thread.boardid = $board AND thread.forumid = $forum '
+                                         'AND thread.parent = $msgno',
+                                   order='thread.id'))
+        web.header('Content-Type', 'text/html; charset=utf-8')
+        return render.message(board, message.boardname, forum, message.forumname,
+                             message, reference, followups, prevmsg, nextmsg)
+
+class ExportPacket:
+    """
+    Download the messages in a forum as a QWK packet, for offline
+    readers. Only messages numbered above since are included, so
+    readers can fetch just the messages they have not seen yet.
+    """
+    @authorized
+    def GET(self, board, forum):
+        form = web.input(since=0)
+        forum = int(forum)
         try:
-            boardname = boardnames[0].title
-        except IndexError:
+            since = int(form.since)
+        except ValueError:
+            raise web.badrequest()
+        boardnames = list(db.select('board', locals(), where='id = $board'))
+        if not boardnames:
             return "Unknown board."
-        forumnames = db.select('forum', locals(), where='id = $forum AND boardid = $board')
-        #if not forumnames:
-        #    return "Unknown forum."
-        try:
-            forumname = forumnames[0].title
-        except IndexError:
+        forumnames = list(db.select('forum', locals(), where='id = $forum AND boardid = $board'))
+        if not forumnames:
             return "Unknown forum."
-        # Retrieve and display message.
-        messages = list(db.select('message', locals(),
-                       where='id = $msgno AND forumid = $forum AND boardid = $board'))
-        if len(messages) != 1:
+        bbsid = qwkencode(board.upper())
+        # The packet is built in a temporary file and then sent from
+        # there, so neither the messages nor the packet are held in
+        # memory.
+        packet = tempfile.TemporaryFile()
+        writer = QwkWriter(packet, bbsid, qwkencode(boardnames[0].title))
+        writer.add_forum(forum, qwkencode(forumnames[0].title))
+        for row in db.select('message', locals(), what=MESSAGECOLUMNS,
+                             where='boardid = $board AND forumid = $forum AND id > $since',
+                             order='id'):
+            writer.add_message(qwkmessage(row))
+        writer.close()
+        web.header('Content-Type', 'application/zip')
+        web.header('Content-Disposition', 'attachment; filename="%s.QWK"' % bbsid)
+        web.header('Content-Length', str(packet.tell()))
+        return filechunks(packet)
+
+class ViewThread:
+    """
+    View a whole thread from a given board and forum.
+    """
+    @authorized
+    @cached
+    def GET(self, board, forum, root):
+        forum = int(forum)
+        root = int(root)
+        boardnames = list(db.select('board', locals(), where='id = $board'))
+        if not boardnames:
+            return "Unknown board."
+        boardname = boardnames[0].title
+        forumnames = list(db.select('forum', locals(), where='id = $forum AND boardid = $board'))
+        if not forumnames:
+            return "Unknown forum."
+        forumname = forumnames[0].title
+        # Show the whole thread even if asked for a reply in it.
+        roots = list(db.select('thread', locals(), what='root',
+                     where='id = $root AND forumid = $forum AND boardid = $board'))
+        if not roots:
             return "No such message."
-        message = messages[0]
-        if not message.reference:
-            reference = None
-        else:
-            refno = message.reference
-            references = list(db.select('message', locals(),
-                        where='id = $refno AND forumid = $forum AND boardid = $board'))
-            if len(references) > 0:
-                reference = references[0]
-            else:
-                reference = None
-        followups = list(db.select('message', locals(),
-                        where='reference = $msgno AND forumid = $forum AND boardid = $board'))
-        prevmsgs = list(db.select('message', locals(),
-                        what='id, mfrom, mto, subject',
-                        where='boardid = $board AND forumid = $forum AND id < $msgno',
-                        order='id DESC', limit=1))
-        if prevmsgs:
-            prevmsg = prevmsgs[0]
-        else:
-            prevmsg = None
-        nextmsgs = list(db.select('message', locals(),
-                        what='id, mfrom, mto, subject',
-                        where='boardid = $board AND forumid = $forum AND id > $msgno',
-                        order='id ASC', limit=1))
-        if nextmsgs:
-            nextmsg = nextmsgs[0]
-        else:
-            nextmsg = None
+        if roots[0].root != root:
+            raise web.seeother('/%s/%d/thread/%d' % (board, forum, roots[0].root))
+        messages = list(db.select('thread JOIN message ON message.boardid = thread.boardid '
+                                  'AND message.forumid = thread.forumid AND message.id = thread.id',
+                                  locals(),
+                                  what=MESSAGECOLUMNS + ', thread.parent, thread.depth',
+                                  where='thread.boardid = $board AND thread.forumid = $forum '
+                                        'AND thread.root = $root',
+                                  order='thread.path'))
         web.header('Content-Type', 'text/html; charset=utf-8')
-        return render.message(board, boardname, forum, forumname, message, reference, followups,
-                             prevmsg, nextmsg)
+        return render.thread(board, boardname, forum, forumname, messages)
 
 
-web.webapi.internalerror = web.debugerror
 app = web.application(urls, globals())
+app.internalerror = internalerror
+app.add_processor(qwkmetrics.requestTimer(urls))
 application = app.wsgifunc()
 
 if __name__ == '__main__':
@@ -1,16 +1,32 @@
+-- generation is bumped and modified (a Unix time) set whenever messages
+-- are imported into the board. Cached pages of the board expire then.
 CREATE TABLE IF NOT EXISTS board (
     id TEXT PRIMARY KEY,
-    title TEXT NOT NULL
+    title TEXT NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 0,
+    modified INTEGER NOT NULL DEFAULT 0
     );
 
 CREATE TABLE IF NOT EXISTS forum (
     id INTEGER NOT NULL,
     boardid TEXT NOT NULL,
     title TEXT NOT NULL,
+    mcount INTEGER NOT NULL DEFAULT 0,
     PRIMARY KEY (id, boardid),
     FOREIGN KEY (boardid) REFERENCES board(id)
     );
 
+-- People messages are from and to, by name. Names are matched without
+-- regard to case, as QWK software varies in how it writes them.
+CREATE TABLE IF NOT EXISTS author (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE COLLATE NOCASE
+    );
+
+-- mdate and mtime are as found in the packet. posted is the same as a
+-- Unix time, taking them to be UTC, or 0 if they are not a valid date
+-- (see qwk.timestamp()). fromid and toid are the authors of mfrom and
+-- mto.
 CREATE TABLE IF NOT EXISTS message (
     id INTEGER NOT NULL,
     forumid INTEGER NOT NULL,
@@ -23,8 +39,107 @@ CREATE TABLE IF NOT EXISTS message (
     reference INTEGER,
     subject TEXT NOT NULL,
     body BLOB NOT NULL,
+    posted INTEGER NOT NULL DEFAULT 0,
+    fromid INTEGER REFERENCES author(id),
+    toid INTEGER REFERENCES author(id),
 
     PRIMARY KEY (id, forumid, boardid),
     FOREIGN KEY (forumid) REFERENCES forum(id),
     FOREIGN KEY (boardid) REFERENCES board(id)
     );
+
+-- Indexes for paging through a forum by message number or date.
+CREATE INDEX IF NOT EXISTS message_forum_id ON message (boardid, forumid, id);
+CREATE INDEX IF NOT EXISTS message_forum_posted ON message (boardid, forumid, posted, id);
+
+-- Indexes for browsing the archive by date and by author.
+CREATE INDEX IF NOT EXISTS message_posted ON message (posted);
+CREATE INDEX IF NOT EXISTS message_from ON message (fromid, posted);
+CREATE INDEX IF NOT EXISTS message_to ON message (toid, posted);
+
+-- Where each message sits in its thread and in its forum. Maintained by
+-- the importer. parent is the message replied to, if it is in the
+-- archive; root is the first message of the thread. path lists the
+-- zero padded message numbers from the root down to the message, so
+-- sorting on it gives the thread in reply order. prevno and nextno
+-- are the neighbouring message numbers in the forum.
+CREATE TABLE IF NOT EXISTS thread (
+    id INTEGER NOT NULL,
+    forumid INTEGER NOT NULL,
+    boardid TEXT NOT NULL,
+
+    reference INTEGER,
+    parent INTEGER,
+    root INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    prevno INTEGER,
+    nextno INTEGER,
+
+    PRIMARY KEY (boardid, forumid, id)
+    );
+
+CREATE INDEX IF NOT EXISTS thread_parent ON thread (boardid, forumid, parent);
+CREATE INDEX IF NOT EXISTS thread_path ON thread (boardid, forumid, root, path);
+-- Replies whose parent has not arrived yet.
+CREATE INDEX IF NOT EXISTS thread_orphan ON thread (boardid, forumid, reference)
+    WHERE parent IS NULL;
+
+-- Packets loaded by the command line importer, keyed on the SHA-1 of the
+-- packet file, so that an interrupted bulk import can be resumed.
+CREATE TABLE IF NOT EXISTS packet (
+    checksum TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    boardid TEXT NOT NULL,
+    messages INTEGER NOT NULL,
+    imported INTEGER NOT NULL
+    );
+
+-- Dictionaries that message bodies are compressed against, made by
+-- qwkcompress.py. A body stored as a BLOB is compressed: its first byte
+-- is the id of its dictionary, and the rest is deflate data following on
+-- from the dictionary. Once a dictionary exists, the importers compress
+-- new messages with the newest one. See qwkbody.py.
+CREATE TABLE IF NOT EXISTS bodydict (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+    );
+
+-- Message text as the full-text index reads it, with bodies decompressed
+-- by the qwkbody() function that qwkdb adds to its connections.
+CREATE VIEW IF NOT EXISTS message_text AS
+    SELECT rowid AS msgrowid, subject, qwkbody(body) AS body, mfrom, mto FROM message;
+
+-- Full-text index over message text. The index stores no text of its own
+-- and reads it from message_text, keyed on message's rowid. SQLite may
+-- renumber message rowids in a VACUUM, so vacuum with qwkcompress.py
+-- --vacuum, which rebuilds the index afterwards.
+CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5 (
+    subject, body, mfrom, mto,
+    content='message_text', content_rowid='msgrowid'
+    );
+
+CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+    INSERT INTO message_fts (rowid, subject, body, mfrom, mto)
+        VALUES (new.rowid, new.subject, qwkbody(new.body), new.mfrom, new.mto);
+END;
+
+CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+    INSERT INTO message_fts (message_fts, rowid, subject, body, mfrom, mto)
+        VALUES ('delete', old.rowid, old.subject, qwkbody(old.body), old.mfrom, old.mto);
+END;
+
+-- Compressing a body in place leaves its text, and so the index, as it
+-- was. Only updates of the indexed columns run the trigger, so others
+-- can be made where qwkbody() is not available, such as in the sqlite3
+-- shell.
+CREATE TRIGGER IF NOT EXISTS message_fts_update
+    AFTER UPDATE OF subject, body, mfrom, mto ON message
+    WHEN old.subject IS NOT new.subject OR old.mfrom IS NOT new.mfrom
+        OR old.mto IS NOT new.mto OR qwkbody(old.body) IS NOT qwkbody(new.body)
+BEGIN
+    INSERT INTO message_fts (message_fts, rowid, subject, body, mfrom, mto)
+        VALUES ('delete', old.rowid, old.subject, qwkbody(old.body), old.mfrom, old.mto);
+    INSERT INTO message_fts (rowid, subject, body, mfrom, mto)
+        VALUES (new.rowid, new.subject, qwkbody(new.body), new.mfrom, new.mto);
+END;
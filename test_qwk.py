@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# Tests of the QWK library.
+
+"""
+Tests of qwk.py. Run from the QwkWeb folder with:
+
+  python -m unittest discover
+"""
+
+import calendar
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from zipfile import ZipFile
+import qwk
+from qwk import QwkMessage, QwkPacket, QwkWriter
+
+
+def header(status=' ', number='1', date='01-02-95', time='10:00', mto='ALL',
+           mfrom='SYSOP', subject='Hello', password='', reference='',
+           blocks='2', forum=1, pad=' '):
+    """
+    Returns a MESSAGES.DAT header, with its fields padded with pad.
+    """
+    def field(value, length):
+        return value + pad * (length - len(value))
+    return struct.pack(QwkWriter.record_layout, status, field(number, 7),
+                       field(date, 8), field(time, 5), field(mto, 25),
+                       field(mfrom, 25), field(subject, 25), field(password, 12),
+                       field(reference, 8), field(blocks, 6), chr(225), forum, 1, ' ')
+
+
+class PacketTestCase(unittest.TestCase):
+    """
+    Writes packets into a temporary folder, removed afterwards.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='qwktest')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def writePacket(self, messages, forums=(1, 2)):
+        """
+        Writes a packet of (number, forum) messages. Returns its path.
+        """
+        path = os.path.join(self.folder, 'TEST.QWK')
+        writer = QwkWriter(path, 'TEST', 'Test BBS')
+        for forum in forums:
+            writer.add_forum(forum, 'Forum %d' % forum)
+        for number, forum in messages:
+            writer.add_message(QwkMessage(' ', number, '01-02-95', '10:00', 'ALL',
+                                          'SYSOP', 'Message %d' % number, '', 0,
+                                          forum, body='Body of %d\n' % number))
+        writer.close()
+        return path
+
+
+class DecodeHeadersTest(PacketTestCase):
+    """
+    Headers decode the same with numpy and with struct.
+    """
+    def decode(self, data, usenumpy):
+        packet = QwkPacket(self.writePacket([]))
+        saved = qwk.numpy
+        if not usenumpy:
+            qwk.numpy = None
+        try:
+            return packet._decodeHeaders(data, [0])
+        finally:
+            qwk.numpy = saved
+
+    def checkBoth(self, data, expected):
+        self.assertEqual(self.decode(data, False), [expected])
+        if qwk.numpy is not None:
+            self.assertEqual(self.decode(data, True), [expected])
+
+    def testSpacePadded(self):
+        self.checkBoth(header(reference='12'), (' ', 1, '01-02-95', '10:00', 'ALL',
+                                                'SYSOP', 'Hello', '', 12, 2, 1))
+
+    def testNullPadded(self):
+        self.checkBoth(header(status='\0', reference='12', pad='\0'),
+                       (' ', 1, '01-02-95', '10:00', 'ALL', 'SYSOP', 'Hello', '', 12, 2, 1))
+
+    def testMixedPadding(self):
+        self.checkBoth(header(subject='Hello \0', number=' 7', pad='\0'),
+                       (' ', 7, '01-02-95', '10:00', 'ALL', 'SYSOP', 'Hello', '', 0, 2, 1))
+
+
+class IndexTest(PacketTestCase):
+    """
+    Messages are found by forum and position with the NDX files when
+    they fit MESSAGES.DAT, and without them otherwise.
+    """
+    def setUp(self):
+        PacketTestCase.setUp(self)
+        self.messages = [(number, number % 3 and 1 or 2) for number in range(1, 31)]
+        self.packet = self.writePacket(self.messages)
+        self.unpacked = os.path.join(self.folder, 'unpacked')
+        ZipFile(self.packet).extractall(self.unpacked)
+
+    def check(self, path):
+        packet = QwkPacket(path, eager=False)
+        for forum in (1, 2):
+            self.assertEqual([message.number for message in packet.forum_messages(forum)],
+                             [number for number, f in self.messages if f == forum])
+        self.assertEqual(packet.message_at(29).number, 30)
+        self.assertEqual(packet.message_at(0).number, 1)
+
+    def testZip(self):
+        self.check(self.packet)
+
+    def testIndex(self):
+        self.assertNotEqual(QwkPacket(self.unpacked, eager=False)._readIndex(), None)
+        self.check(self.unpacked)
+
+    def testMissingIndex(self):
+        os.remove(os.path.join(self.unpacked, '002.NDX'))
+        self.assertEqual(QwkPacket(self.unpacked, eager=False)._readIndex(), None)
+        self.check(self.unpacked)
+
+    def testOffsetInBody(self):
+        # Point the first message of forum 1 at its body instead
+        name = os.path.join(self.unpacked, '001.NDX')
+        data = open(name, 'rb').read()
+        block = int(qwk.unmsbin(data[:4]))
+        open(name, 'wb').write(qwk.msbin(block + 1) + data[4:])
+        self.assertEqual(QwkPacket(self.unpacked, eager=False)._readIndex(), None)
+        self.check(self.unpacked)
+
+
+class MsbinTest(unittest.TestCase):
+    """
+    NDX block numbers survive the round trip through Microsoft Binary
+    Format.
+    """
+    def testRoundTrip(self):
+        for number in (0, 1, 2, 3, 127, 128, 1000, 65535, 2 ** 20):
+            data = qwk.msbin(number)
+            self.assertEqual(len(data), 4)
+            self.assertEqual(qwk.unmsbin(data), number)
+
+    def testKnownValues(self):
+        # 1 and 2 as written by other QWK software
+        self.assertEqual(qwk.msbin(1), '\0\0\0\x81')
+        self.assertEqual(qwk.msbin(2), '\0\0\0\x82')
+        self.assertEqual(qwk.msbin(0), '\0\0\0\0')
+
+
+class TimestampTest(unittest.TestCase):
+    """
+    Two digit years below qwk.YEARPIVOT are in the 2000s, and dates that
+    are not valid are 0.
+    """
+    def testPivot(self):
+        self.assertEqual(qwk.timestamp('12-31-79', '23:59'),
+                         calendar.timegm((2079, 12, 31, 23, 59, 0)))
+        self.assertEqual(qwk.timestamp('01-01-80', '00:00'),
+                         calendar.timegm((1980, 1, 1, 0, 0, 0)))
+        self.assertEqual(qwk.timestamp('01-01-00', '10:30'),
+                         calendar.timegm((2000, 1, 1, 10, 30, 0)))
+        self.assertEqual(qwk.timestamp('12-31-99', '10:30'),
+                         calendar.timegm((1999, 12, 31, 10, 30, 0)))
+
+    def testLeapYears(self):
+        self.assertEqual(qwk.timestamp('02-29-00', '12:00'),
+                         calendar.timegm((2000, 2, 29, 12, 0, 0)))
+        self.assertEqual(qwk.timestamp('02-29-01', '12:00'), 0)
+
+    def testInvalid(self):
+        for date, time in (('13-01-95', '10:00'), ('00-01-95', '10:00'),
+                           ('01-32-95', '10:00'), ('01-02-95', '24:00'),
+                           ('01-02-95', '10:60'), ('1-2-95', '10:00'),
+                           ('01/02/95', '10:00'), ('01-02-1995', '10:00'),
+                           ('01-02-95', '10.00'), ('', '')):
+            self.assertEqual(qwk.timestamp(date, time), 0, (date, time))
+
+
+if __name__ == '__main__':
+    unittest.main()
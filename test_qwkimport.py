@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Tests of the packet importer.
+
+"""
+Tests of qwkimport.py, against databases in a temporary folder. Run
+from the QwkWeb folder with:
+
+  python -m unittest discover
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import ConfigParser
+from qwk import QwkMessage, QwkPacket, QwkWriter
+from qwkimport import PacketImporter
+import qwkdb
+
+
+class ThreadTest(unittest.TestCase):
+    """
+    Messages are threaded and linked to their neighbours the same
+    whatever order they arrive in.
+    """
+    # Message number and the number it replies to.
+    messages = [(1, 0), (2, 1), (3, 2), (4, 3), (5, 0), (6, 1), (7, 8), (8, 7)]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='qwktest')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def database(self, name, packets):
+        """
+        Makes a database and imports packets of message numbers into it,
+        one after the other. Returns a connection to it.
+        """
+        path = os.path.join(self.folder, name)
+        con = sqlite3.connect(path)
+        con.executescript(open('sqlite.sql').read())
+        con.close()
+        con = qwkdb.connect(path, ConfigParser.ConfigParser())
+        references = dict(self.messages)
+        for x, numbers in enumerate(packets):
+            packet = os.path.join(self.folder, '%s-%d.QWK' % (name, x))
+            writer = QwkWriter(packet, 'TEST', 'Test BBS')
+            writer.add_forum(1, 'Forum')
+            for number in numbers:
+                writer.add_message(QwkMessage(' ', number, '01-02-95', '10:00', 'ALL',
+                                              'SYSOP', 'Message %d' % number, '',
+                                              references[number], 1, body='Body\n'))
+            writer.close()
+            PacketImporter(con).importPacket(QwkPacket(packet, eager=False))
+        return con
+
+    def threads(self, con):
+        return con.execute('SELECT id, parent, root, depth, path, prevno, nextno '
+                           'FROM thread ORDER BY id').fetchall()
+
+    def testInOrder(self):
+        con = self.database('order.db', [[number for number, reference in self.messages]])
+        rows = dict([(row[0], row[1:]) for row in self.threads(con)])
+        self.assertEqual(rows[1], (None, 1, 0, u'0000001/', None, 2))
+        self.assertEqual(rows[4], (3, 1, 3, u'0000001/0000002/0000003/0000004/', 3, 5))
+        self.assertEqual(rows[6], (1, 1, 1, u'0000001/0000006/', 5, 7))
+        self.assertEqual(rows[8], (7, 7, 1, u'0000007/0000008/', 7, None))
+
+    def testOrphansAdopted(self):
+        expected = self.threads(self.database('order.db',
+            [[number for number, reference in self.messages]]))
+        # Replies first, then the messages they reply to, one packet at
+        # a time
+        con = self.database('orphans.db', [[4], [3, 6], [8, 5], [2], [1, 7]])
+        rows = self.threads(con)
+        self.assertEqual(rows[:6], expected[:6])
+        # 7 and 8 reply to each other. Whichever came first starts the
+        # thread, rather than them making a loop.
+        self.assertEqual([row[:5] for row in rows[6:]],
+                         [(7, 8, 8, 1, u'0000008/0000007/'), (8, None, 8, 0, u'0000008/')])
+        self.assertEqual([row[5:] for row in rows[6:]], [row[5:] for row in expected[6:]])
+
+    def testDuplicates(self):
+        con = self.database('duplicates.db', [[1, 2, 3], [2, 3, 4, 5, 6, 7, 8]])
+        self.assertEqual(con.execute('SELECT count(*) FROM message').fetchone()[0], 8)
+        self.assertEqual(con.execute('SELECT mcount FROM forum').fetchone()[0], 8)
+        self.assertEqual(self.threads(con), self.threads(self.database('order.db',
+            [[number for number, reference in self.messages]])))
+
+    def testPaths(self):
+        con = self.database('orphans.db', [[4], [3, 6], [8, 5], [2], [1, 7]])
+        # Sorting on the path lists a thread depth first
+        self.assertEqual([row[0] for row in con.execute(
+            'SELECT id FROM thread WHERE root = 1 ORDER BY path')], [1, 2, 3, 4, 6])
+        for msgno, root, depth, path in con.execute('SELECT id, root, depth, path FROM thread'):
+            steps = path.split('/')[:-1]
+            self.assertEqual(len(steps), depth + 1)
+            self.assertEqual((int(steps[0]), int(steps[-1])), (root, msgno))
+
+
+if __name__ == '__main__':
+    unittest.main()
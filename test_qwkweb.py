@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# Tests of the web interface.
+
+"""
+Tests of qwkweb.py, against a database in a temporary folder. Run from
+the QwkWeb folder, as the web interface renders its pages with the
+templates there:
+
+  python -m unittest discover
+"""
+
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import ConfigParser
+from base64 import b64encode
+from qwk import QwkMessage, QwkPacket, QwkWriter
+from qwkimport import PacketImporter
+import qwkdb
+
+AUTHORIZATION = {'HTTP_AUTHORIZATION': 'Basic ' + b64encode('archives:archives')}
+
+# Message links and pager links in listings.
+messagelink = re.compile(r'<a href="/test/1/(\d+)">')
+pagerlink = re.compile(r'href="([^"]*)&amp;(after|before)=([-\w=]*)"')
+
+
+def application(database):
+    """
+    Returns the web application, reading from database and caching no
+    pages.
+    """
+    configfile = database + '.conf'
+    config = ConfigParser.ConfigParser()
+    config.add_section('qwkweb')
+    config.set('qwkweb', 'dbn', 'sqlite')
+    config.set('qwkweb', 'db', database)
+    file = open(configfile, 'wb')
+    try:
+        config.write(file)
+    finally:
+        file.close()
+    configfiles = qwkdb.CONFIGFILES
+    qwkdb.CONFIGFILES = [configfile]
+    try:
+        import qwkweb
+    finally:
+        qwkdb.CONFIGFILES = configfiles
+    from qwkcache import ResponseCache
+    qwkweb.db = qwkdb.database(config)
+    qwkweb.cache = ResponseCache(0)
+    return qwkweb
+
+
+class ListingTest(unittest.TestCase):
+    """
+    Following the pager links of a listing either way lists every
+    message once, in order.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='qwktest')
+        self.database = os.path.join(self.folder, 'qwkweb.db')
+        con = sqlite3.connect(self.database)
+        con.executescript(open('sqlite.sql').read())
+        con.close()
+        # Few authors, subjects and dates, so that orders have ties,
+        # and a date that is not valid
+        packet = os.path.join(self.folder, 'TEST.QWK')
+        writer = QwkWriter(packet, 'TEST', 'Test BBS')
+        writer.add_forum(1, 'Forum')
+        for number in range(1, 24):
+            writer.add_message(QwkMessage(' ', number,
+                number == 5 and '13-45-95' or '01-%02d-95' % (number % 4 + 1),
+                '10:%02d' % (number % 2), 'USER %d' % (number % 3),
+                'USER %d' % (number % 5), 'Subject %d' % (number % 4), '', 0, 1,
+                body='Body\n'))
+        writer.close()
+        con = qwkdb.connect(self.database, ConfigParser.ConfigParser())
+        PacketImporter(con).importPacket(QwkPacket(packet, eager=False))
+        con.close()
+        self.qwkweb = application(self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def get(self, path):
+        response = self.qwkweb.app.request(path, env=AUTHORIZATION)
+        self.assertEqual(response.status, '200 OK', path)
+        return response.data
+
+    def links(self, data):
+        links = {}
+        for link, direction, cursor in pagerlink.findall(data):
+            links[direction] = '%s&%s=%s' % (link.replace('&amp;', '&'), direction, cursor)
+        return links
+
+    def expected(self, columns):
+        con = sqlite3.connect(self.database)
+        try:
+            return [row[0] for row in con.execute(
+                "SELECT id FROM message WHERE boardid = 'test' AND forumid = 1 "
+                "ORDER BY %s" % ', '.join(columns))]
+        finally:
+            con.close()
+
+    def walk(self, path, direction):
+        """
+        Follows the pager links in one direction from path. Returns the
+        message numbers of each page in the order visited, and the path
+        of the last page.
+        """
+        pages = []
+        while True:
+            data = self.get(path)
+            pages.append([int(x) for x in messagelink.findall(data)])
+            links = self.links(data)
+            if direction not in links:
+                return pages, path
+            path = links[direction]
+
+    def testOrders(self):
+        for order, columns in self.qwkweb.ForumIndex.orders.items():
+            expected = self.expected(columns)
+            forward, last = self.walk('/test/1?order=%s&size=5' % order, 'after')
+            self.assertEqual(sum(forward, []), expected, order)
+            self.assertEqual([len(page) for page in forward], [5, 5, 5, 5, 3], order)
+            # Back from the last page, the same pages in reverse
+            backward, first = self.walk(last, 'before')
+            backward.reverse()
+            self.assertEqual(backward, forward, order)
+            # The first page, found either way, has no previous page
+            self.assertFalse('before' in self.links(self.get(first)), order)
+
+    def testCursors(self):
+        # Bad cursors are refused rather than failing
+        for cursor in ('zz', 'WzFd', 'eyJhIjogMX0='):
+            response = self.qwkweb.app.request('/test/1?order=mdate&after=' + cursor,
+                                               env=AUTHORIZATION)
+            self.assertEqual(response.status, '400 Bad Request', cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()